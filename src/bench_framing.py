@@ -0,0 +1,93 @@
+import json
+import time
+import zlib
+
+import utils
+
+
+class Stream:
+    """Socket stand-in handing the frames of `data` to FrameReader.read in SOCK_BUFSIZE reads"""
+
+    def __init__(self, data):
+        self.data = memoryview(data)
+        self.offset = 0
+
+    def recv_into(self, buffer):
+        if self.offset == len(self.data):
+            raise BlockingIOError
+        size = min(len(buffer), utils.SOCK_BUFSIZE, len(self.data) - self.offset)
+        buffer[:size] = self.data[self.offset:self.offset + size]
+        self.offset += size
+        return size
+
+
+def make_data(size):
+    """NODES_GET like JSON data of about `size` bytes"""
+    nodes = []
+    node = {'_id': '', 'gateway_id': 'gateway_1', 'nodetype_id': 'MTM-CM5000-SMA', 'image_name': 'blink.ihex',
+            'flashed': 'FLASH_FINISHED', 'location': {'building': 'Building_A', 'floor': 'Floor_1', 'area': 'Area_2'}}
+    while len(json.dumps(nodes)) < size:
+        nodes.append(dict(node, _id='node_%d' % len(nodes)))
+    return json.dumps(nodes).encode()
+
+
+def bench(function, data_size, min_time):
+    """Run function until min_time seconds have passed, return (runs per second, MB per second)"""
+    runs = 0
+    start = time.perf_counter()
+    while True:
+        function()
+        runs += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            return runs / elapsed, runs * data_size / elapsed / 1e6
+
+
+def bench_encode(data, version, compress, min_time):
+    return bench(lambda: utils.Response(data).to_bytes(version, compress), len(data), min_time)
+
+
+def bench_decode(data, version, compress, frames, min_time):
+    flags = 0
+    payload = data
+    if compress:
+        flags = utils.FLAG_COMPRESSED
+        payload = zlib.compress(data, utils.COMPRESS_LEVEL)
+    stream = bytes(utils.create_request_packet(utils.NODES_GET, payload, version, flags)) * frames
+
+    def run():
+        s = Stream(stream)
+        reader = utils.FrameReader()
+        reader.version = version
+        decoded = 0
+        while decoded < frames:
+            for frame in reader.read(s):
+                utils.segment_packet(frame, version=version)
+                decoded += 1
+
+    return bench(run, len(data) * frames, min_time)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                     description='Encode/decode throughput of the PROTOCOL_V1 and PROTOCOL_V2 frames')
+    parser.add_argument('--sizes', '-s', default='1024,16384,60000,1048576',
+                        help='Comma separated data sizes, in bytes')
+    parser.add_argument('--frames', '-f', type=int, default=16, help='Frames decoded per run')
+    parser.add_argument('--time', '-t', type=float, default=1.0, help='Seconds per measure')
+    args = parser.parse_args()
+
+    print('%-8s %-7s %-8s %12s %10s %12s %10s' % ('size', 'version', 'compress', 'encode/s', 'enc MB/s',
+                                                 'decode/s', 'dec MB/s'))
+    for size in [int(size) for size in args.sizes.split(',')]:
+        data = make_data(size)
+        for version, compress in ((utils.PROTOCOL_V1, False), (utils.PROTOCOL_V2, False),
+                                  (utils.PROTOCOL_V2, True)):
+            if version == utils.PROTOCOL_V1 and len(data) > 0xFFFF:
+                continue
+            encode_rate, encode_mb = bench_encode(data, version, compress, args.time)
+            decode_rate, decode_mb = bench_decode(data, version, compress, args.frames, args.time)
+            print('%-8d %-7d %-8s %12.0f %10.1f %12.0f %10.1f' % (len(data), version, compress, encode_rate,
+                                                                 encode_mb, decode_rate * args.frames, decode_mb))
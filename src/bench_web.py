@@ -0,0 +1,88 @@
+import json
+import socket
+import struct
+import threading
+import time
+
+import utils
+
+
+def recv_exactly(s, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = s.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError('Connection closed by the server')
+        data.extend(chunk)
+    return data
+
+
+def run_client(addr, pck, requests, timeout, latencies, errors, start_event):
+    """Send the request `requests` times on one connection, waiting for each response"""
+    try:
+        s = socket.create_connection(addr, timeout)
+    except OSError as e:
+        errors.append(e)
+        return
+    start_event.wait()
+    try:
+        for _ in range(requests):
+            start = time.perf_counter()
+            s.sendall(pck)
+            size = struct.unpack('!H', recv_exactly(s, utils.SIZE_OF_DATA))[0]
+            recv_exactly(s, size)
+            latencies.append(time.perf_counter() - start)
+    except OSError as e:
+        errors.append(e)
+    finally:
+        s.close()
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def bench(addr, action, data, clients, requests, timeout):
+    """Run `clients` concurrent connections against the server, return (elapsed, latencies, errors)"""
+    pck = bytes(utils.create_request_packet(action.encode(), json.dumps(data).encode()))
+    latencies = []
+    errors = []
+    start_event = threading.Event()
+    threads = [threading.Thread(target=run_client,
+                                args=(addr, pck, requests, timeout, latencies, errors, start_event))
+               for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    start = time.perf_counter()
+    start_event.set()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - start, latencies, errors
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                     description='Load a running server with concurrent web clients and report the '
+                                                 'request throughput and latency')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', '-p', type=int, default=50000)
+    parser.add_argument('--action', '-a', default=utils.NODETYPES_GET.decode(), help='Request action')
+    parser.add_argument('--data', '-d', default='{}', help='Request data (JSON), e.g. {"token": "..."}')
+    parser.add_argument('--clients', '-c', type=int, default=100, help='Concurrent connections')
+    parser.add_argument('--requests', '-n', type=int, default=100, help='Requests per connection')
+    parser.add_argument('--timeout', '-t', type=float, default=10, help='Seconds a client waits on the server')
+    args = parser.parse_args()
+
+    elapsed, latencies, errors = bench((args.host, args.port), args.action, json.loads(args.data), args.clients,
+                                       args.requests, args.timeout)
+    print('%d requests in %.2fs (%d clients): %.0f req/s' % (len(latencies), elapsed, args.clients,
+                                                               len(latencies) / elapsed))
+    if latencies:
+        print('latency ms: p50 %.2f  p99 %.2f  max %.2f' % (percentile(latencies, 50) * 1000,
+                                                             percentile(latencies, 99) * 1000,
+                                                             max(latencies) * 1000))
+    if errors:
+        print('%d client errors, e.g. %r' % (len(errors), errors[0]))
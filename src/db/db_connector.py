@@ -1,12 +1,13 @@
 import pymongo
+from pymongo import UpdateOne, ReplaceOne, DeleteMany
 from pymongo.errors import ConnectionFailure
 import bson
 from bson.objectid import ObjectId
 import os
 import logging.config
-import json
 
 import db.utils as utils
+import db.topology as topology
 import xml_handler
 
 
@@ -18,6 +19,8 @@ class DBConnector:
         self.db = self.client[utils.CLIENT]
         logging.config.fileConfig(os.path.dirname(os.path.abspath(__file__)) + '/../' + 'logging.conf')
         self.logger = logging.getLogger('db')
+        self.topology = topology.TopologyCache()
+        self.nodetypes_version = utils.new_version()
 
     def check_connection(self):
         try:
@@ -32,8 +35,8 @@ class DBConnector:
         self.db.close()
 
     def insert_gateway(self, gateway, location, nodes):
-        gateway = self.serialize(gateway)
-        nodes = self.serialize(nodes)
+        gateway = gateway.to_document()
+        nodes = [node.to_document() for node in nodes]
         self.logger.info('Insert Gateway[%s]' % (gateway[utils.GATEWAY_UID]))
         gateway[utils.LOCATION] = location
 
@@ -45,73 +48,151 @@ class DBConnector:
         else:
             self.db[utils.GATEWAYS].insert_one(gateway)
 
+        self.topology.set_gateway(gateway[utils.GATEWAY_UID], gateway[utils.GATEWAY_ADDRESS])
+        self.topology.set_nodes(nodes)
+
     def update_gateway_nodes(self, gateway, nodes):
-        gateway = self.serialize(gateway)
-        nodes = self.serialize(nodes)
+        """Reconcile the stored nodes of a gateway with the nodes it reported"""
+        gateway = gateway.to_document()
+        nodes = [node.to_document() for node in nodes]
         self.logger.info('Update Gateway[%s]' % (gateway[utils.GATEWAY_UID]))
 
-        new_nodes = []
-        for node in nodes:
-            new_nodes.append(node[utils.NODE_ID])
-
-        prev_nodes = []
-        # Return a list so you can iterate over the result many times...pymongo cursor
-        existing_nodes = list(self.db[utils.NODES].find({utils.GATEWAY_ID: gateway[utils.GATEWAY_UID]},
-                                                        {utils.NODE_UID: 1, utils.NODE_ID: 1}))
-        for node in existing_nodes:
-            prev_nodes.append(node[utils.NODE_ID])
-
-        insert_nodes_ids = set(new_nodes) - set(prev_nodes)
-        for node_id in insert_nodes_ids:
-            for node in nodes:
-                if node_id == node[utils.NODE_ID]:
-                    self.db[utils.NODES].insert_one(node)
-
-        delete_nodes_ids = set(prev_nodes) - set(new_nodes)
-        for node_id in delete_nodes_ids:
-            for node in existing_nodes:
-                if node_id == node[utils.NODE_ID]:
-                    self.db[utils.NODES].delete_one({utils.NODE_UID: node[utils.NODE_UID]})
+        new_nodes = {node[utils.NODE_ID]: node for node in nodes}
+        existing_nodes = {node[utils.NODE_ID]: node for node in self.db[utils.NODES].find(
+            {utils.GATEWAY_ID: gateway[utils.GATEWAY_UID]},
+            {utils.NODE_UID: 1, utils.NODE_ID: 1, utils.NODETYPE_ID: 1, utils.LOCATION: 1})}
+
+        insert_nodes = [node for node_id, node in new_nodes.items() if node_id not in existing_nodes]
+        delete_nodes = [node for node_id, node in existing_nodes.items() if node_id not in new_nodes]
+
+        update_requests = []
+        updated_nodes = []  # [(node_uid, changes)]
+        for node_id, node in new_nodes.items():
+            prev_node = existing_nodes.get(node_id)
+            if prev_node is None:
+                continue
+            changes = {field: node[field] for field in (utils.NODETYPE_ID, utils.LOCATION)
+                       if prev_node.get(field) != node[field]}
+            if changes:
+                update_requests.append(UpdateOne({utils.NODE_UID: prev_node[utils.NODE_UID]}, {"$set": changes}))
+                updated_nodes.append((prev_node[utils.NODE_UID], changes))
+
+        if insert_nodes:
+            self.db[utils.NODES].insert_many(insert_nodes)
+            self.topology.set_nodes(insert_nodes)
+        if delete_nodes:
+            self.delete_many_nodes(delete_nodes)
+        if update_requests:
+            self.db[utils.NODES].bulk_write(update_requests, ordered=False)
+            for node_uid, changes in updated_nodes:
+                self.topology.update_nodes([node_uid], changes)
+
+        self.logger.debug('--- Nodes inserted (%d) deleted (%d) updated (%d)'
+                          % (len(insert_nodes), len(delete_nodes), len(update_requests)))
 
     def delete_gateway(self, _id):
-        # Delete nodes
-        nodes = self.db[utils.NODES].find({utils.GATEWAY_ID: _id}, {utils.NODE_UID: 1, utils.NODE_ID: 1,
-                                                                    utils.IMAGE_NAME: 1})
-        self.delete_many_nodes(nodes)
+        self.delete_gateways([_id])
 
-        # Delete gateway
-        self.db[utils.GATEWAYS].delete_one({utils.GATEWAY_UID: _id})
-        self.logger.debug('Delete Gateway[%s]' % _id)
+    def delete_gateways(self, _ids):
+        """Delete gateways and their nodes with one delete_many per collection"""
+        self.db[utils.NODES].delete_many({utils.GATEWAY_ID: {'$in': _ids}})
+        self.db[utils.GATEWAYS].delete_many({utils.GATEWAY_UID: {'$in': _ids}})
+        for _id in _ids:
+            self.topology.remove_gateway(_id)
+            self.logger.debug('Delete Gateway[%s]' % _id)
 
     def update_gateway_location(self, _id, location):
         self.db[utils.GATEWAYS].update({utils.GATEWAY_UID: _id}, {utils.LOCATION: location})
 
+    def load_topology(self):
+        """Fill the topology cache with the gateways and nodes stored in the DB"""
+        self.topology.load(self.db[utils.GATEWAYS].find({}, {utils.GATEWAY_UID: 1, utils.GATEWAY_ADDRESS: 1}),
+                           self.db[utils.NODES].find())
+        self.logger.debug('Topology loaded %s' % self.topology.stats())
+
     def get_gateway_addr(self, _id):
+        """Address of a gateway, None if it is not stored (e.g. its registration failed)"""
+        gateway_addr = self.topology.get_gateway_addr(_id)
+        if gateway_addr is not None:
+            return gateway_addr
+
         gateway_addr = self.db[utils.GATEWAYS].find_one({utils.GATEWAY_UID: _id}, {utils.GATEWAY_UID: 0,
                                                                                    utils.GATEWAY_ADDRESS: 1})
+        if gateway_addr is None:
+            return None
+        self.topology.miss_resolved()
+        self.topology.set_gateway(_id, gateway_addr[utils.GATEWAY_ADDRESS])
         return gateway_addr[utils.GATEWAY_ADDRESS]
 
     def get_gateway_id_by_node_uid(self, _id):
-        gateway = self.db[utils.NODES].find_one({utils.NODE_UID: ObjectId(_id)},
-                                                {utils.NODE_UID: 0, utils.GATEWAY_ID: 1})
-
-        return gateway[utils.GATEWAY_ID]
+        return self.get_node_by_uid(_id)[utils.GATEWAY_ID]
+
+    def get_gateways_addr(self, _ids):
+        """Return {gateway_id: addr} for all the given gateways, querying the DB once for cache misses"""
+        gateways_addr = {}
+        missing_ids = []
+        for _id in _ids:
+            gateway_addr = self.topology.get_gateway_addr(_id)
+            if gateway_addr is None:
+                missing_ids.append(_id)
+            else:
+                gateways_addr[_id] = gateway_addr
+
+        if missing_ids:
+            gateways = self.db[utils.GATEWAYS].find({utils.GATEWAY_UID: {'$in': missing_ids}},
+                                                    {utils.GATEWAY_UID: 1, utils.GATEWAY_ADDRESS: 1})
+            for gateway in gateways:
+                self.topology.miss_resolved()
+                self.topology.set_gateway(gateway[utils.GATEWAY_UID], gateway[utils.GATEWAY_ADDRESS])
+                gateways_addr[gateway[utils.GATEWAY_UID]] = gateway[utils.GATEWAY_ADDRESS]
+
+        return gateways_addr
 
     def find_gateway_by_addr(self, addr):
-        gateway = self.db[utils.GATEWAYS].find_one({utils.GATEWAY_ADDRESS: addr}, {utils.GATEWAY_UID: 1})
+        gateway_id = self.topology.find_gateway_by_addr(addr)
+        if gateway_id is not None:
+            return gateway_id
 
+        gateway = self.db[utils.GATEWAYS].find_one({utils.GATEWAY_ADDRESS: addr}, {utils.GATEWAY_UID: 1,
+                                                                                   utils.GATEWAY_ADDRESS: 1})
+        self.topology.miss_resolved()
+        self.topology.set_gateway(gateway[utils.GATEWAY_UID], gateway[utils.GATEWAY_ADDRESS])
         return gateway[utils.GATEWAY_UID]
 
     def delete_many_nodes(self, nodes):
+        nodes = list(nodes)
+        if not nodes:
+            return
+
+        node_uids = [node[utils.NODE_UID] for node in nodes]
+        self.db[utils.NODES].delete_many({utils.NODE_UID: {'$in': node_uids}})
+        self.topology.remove_nodes(node_uids)
         for node in nodes:
-            self.db[utils.NODES].delete_one({utils.NODE_UID: node[utils.NODE_UID]})
             self.logger.debug('--- Deleted Node[%s]' % node[utils.NODE_ID])
 
     def node_update_flash_info(self, node_uid, flashed, image_name):
         self.db[utils.NODES].update_one({utils.NODE_UID: ObjectId(node_uid)},
                                         {"$set": {utils.NODE_FLASHED: flashed, utils.IMAGE_NAME: image_name}})
+        self.topology.update_nodes([node_uid], {utils.NODE_FLASHED: flashed, utils.IMAGE_NAME: image_name})
+
+    def nodes_update_flash_info(self, node_uids, flashed, image_name):
+        """Update the flash info of many nodes with a single bulk write"""
+        if not node_uids:
+            return
+
+        requests = [UpdateOne({utils.NODE_UID: ObjectId(node_uid)},
+                              {"$set": {utils.NODE_FLASHED: flashed, utils.IMAGE_NAME: image_name}})
+                    for node_uid in node_uids]
+        self.db[utils.NODES].bulk_write(requests, ordered=False)
+        self.topology.update_nodes(node_uids, {utils.NODE_FLASHED: flashed, utils.IMAGE_NAME: image_name})
+
+    def get_nodes_version(self):
+        return self.topology.version
 
     def get_nodes(self):
+        if self.topology.loaded:
+            return self.topology.get_nodes()
+
         nodes = []
 
         nodes_cursor = self.db[utils.NODES].find()
@@ -124,28 +205,95 @@ class DBConnector:
         return nodes
 
     def get_node_uid_by_gateway_id_and_node_id(self, gateway_uid, node_id):
-        node = self.db[utils.NODES].find_one({utils.GATEWAY_ID: gateway_uid, utils.NODE_ID: node_id},
-                                             {utils.NODE_UID: 1})
+        node_uid = self.topology.get_node_uid(gateway_uid, node_id)
+        if node_uid is not None:
+            return node_uid
 
+        node = self.db[utils.NODES].find_one({utils.GATEWAY_ID: gateway_uid, utils.NODE_ID: node_id})
+        self.topology.miss_resolved()
+        self.topology.set_nodes([node])
         return str(node[utils.NODE_UID])
 
+    def get_node_uids_by_gateway_id_and_node_ids(self, gateway_uid, node_ids):
+        """Return {node_id: node_uid} for the given nodes of a gateway, querying the DB once for cache misses"""
+        node_uids = {}
+        missing_ids = []
+        for node_id in node_ids:
+            node_uid = self.topology.get_node_uid(gateway_uid, node_id)
+            if node_uid is None:
+                missing_ids.append(node_id)
+            else:
+                node_uids[node_id] = node_uid
+
+        if missing_ids:
+            nodes = self.db[utils.NODES].find({utils.GATEWAY_ID: gateway_uid, utils.NODE_ID: {'$in': missing_ids}})
+            for node in nodes:
+                self.topology.miss_resolved()
+                self.topology.set_nodes([node])
+                node_uids[node[utils.NODE_ID]] = str(node[utils.NODE_UID])
+
+        return node_uids
+
     def get_node_id_by_uid(self, _id):
-        node = self.db[utils.NODES].find_one({utils.NODE_UID: ObjectId(_id)}, {utils.NODE_UID: 0, utils.NODE_ID: 1})
-        return node[utils.NODE_ID]
+        return self.get_node_by_uid(_id)[utils.NODE_ID]
+
+    def get_nodes_by_uids(self, _ids):
+        """Return {node_uid: (gateway_id, node_id)} for all the given nodes, querying the DB once for cache misses"""
+        nodes = {}
+        missing_ids = []
+        for _id in _ids:
+            node = self.topology.get_node(_id)
+            if node is None:
+                missing_ids.append(ObjectId(_id))
+            else:
+                nodes[_id] = (node[utils.GATEWAY_ID], node[utils.NODE_ID])
+
+        if missing_ids:
+            for node in self.db[utils.NODES].find({utils.NODE_UID: {'$in': missing_ids}}):
+                self.topology.miss_resolved()
+                self.topology.set_nodes([node])
+                nodes[str(node[utils.NODE_UID])] = (node[utils.GATEWAY_ID], node[utils.NODE_ID])
+
+        return nodes
 
     def get_node_by_uid(self, _id):
+        node = self.topology.get_node(_id)
+        if node is not None:
+            return dict(node)
+
         node = self.db[utils.NODES].find_one({utils.NODE_UID: ObjectId(_id)})
+        self.topology.miss_resolved()
+        self.topology.set_nodes([node])
         node[utils.NODE_UID] = str(node[utils.NODE_UID])
         return node
 
-    def insert_nodetypes(self, nodetypes_file):
-        self.drop_nodetypes()
-        nodetypes = xml_handler.get_nodetypes(nodetypes_file)
-        self.db[utils.NODETYPES].insert(nodetypes)
+    def sync_nodetypes(self, nodetypes_file):
+        """Bring the nodetypes collection in line with the file, return True if anything changed
+
+        Only the nodetypes that differ from the stored documents are written, in a single bulk_write,
+        so readers never see an empty or partial collection.
+        """
+        nodetypes = {nodetype[utils.NODETYPE_UID]: nodetype for nodetype in xml_handler.get_nodetypes(nodetypes_file)}
+        stored = {nodetype[utils.NODETYPE_UID]: nodetype for nodetype in self.db[utils.NODETYPES].find({})}
+
+        requests = [ReplaceOne({utils.NODETYPE_UID: _id}, nodetype, upsert=True)
+                    for _id, nodetype in nodetypes.items() if stored.get(_id) != nodetype]
+        removed = [_id for _id in stored if _id not in nodetypes]
+        if removed:
+            requests.append(DeleteMany({utils.NODETYPE_UID: {'$in': removed}}))
+        if not requests:
+            return False
+
+        self.db[utils.NODETYPES].bulk_write(requests, ordered=False)
+        self.nodetypes_version += 1
+        return True
 
     def drop_nodetypes(self):
         self.db[utils.NODETYPES].drop()
 
+    def get_nodetypes_version(self):
+        return self.nodetypes_version
+
     def get_nodetypes(self):
         nodetypes = []
         cursor = self.db[utils.NODETYPES].find({})
@@ -267,12 +415,3 @@ class DBConnector:
             return {'token': auth_token.decode(), 'status': 200}
         else:
             return {'message': 'User does not exist', 'status': 401}
-
-    @staticmethod
-    def serialize(obj):
-        obj_serialized = json.dumps(obj, default=json_def_encoder)  # Serialized
-        return json.loads(obj_serialized)                           # Dict
-
-
-def json_def_encoder(obj):
-    return obj.__dict__
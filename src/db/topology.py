@@ -0,0 +1,130 @@
+import threading
+import time
+
+import db.utils as utils
+
+
+class TopologyCache:
+    """In-memory index of gateways and nodes
+
+    The cache mirrors the gateways and nodes collections. It is filled once from the DB and then kept
+    up to date by the DBConnector methods that change the topology, so reads become dictionary lookups.
+    `version` changes with every change of the cached topology.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self.gateway_addrs = {}     # {gateway_id: addr}
+        self.gateway_ids = {}       # {(ip, port): gateway_id}
+        self.nodes = {}             # {node_uid: node document}
+        self.node_uids = {}         # {(gateway_id, node_id): node_uid}
+        self.gateway_nodes = {}     # {gateway_id: {node_uids}}
+        self.loaded = False
+
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0              # Misses the DB could answer, i.e. entries the cache should have had
+        self.last_change = time.time()
+        self.version = utils.new_version()
+
+    def load(self, gateways, nodes):
+        with self._lock:
+            self.gateway_addrs.clear()
+            self.gateway_ids.clear()
+            self.nodes.clear()
+            self.node_uids.clear()
+            self.gateway_nodes.clear()
+            for gateway in gateways:
+                self.set_gateway(gateway[utils.GATEWAY_UID], gateway[utils.GATEWAY_ADDRESS])
+            self.set_nodes(nodes)
+            self.loaded = True
+            self._changed()
+
+    def set_gateway(self, gateway_id, addr):
+        with self._lock:
+            prev_addr = self.gateway_addrs.get(gateway_id)
+            if prev_addr is not None:
+                self.gateway_ids.pop(tuple(prev_addr), None)
+            self.gateway_addrs[gateway_id] = addr
+            self.gateway_ids[tuple(addr)] = gateway_id
+            self._changed()
+
+    def remove_gateway(self, gateway_id):
+        with self._lock:
+            addr = self.gateway_addrs.pop(gateway_id, None)
+            if addr is not None:
+                self.gateway_ids.pop(tuple(addr), None)
+            self.remove_nodes(list(self.gateway_nodes.pop(gateway_id, ())))
+            self._changed()
+
+    def set_nodes(self, nodes):
+        with self._lock:
+            for node in nodes:
+                node = dict(node)
+                node[utils.NODE_UID] = str(node[utils.NODE_UID])
+                self.nodes[node[utils.NODE_UID]] = node
+                self.node_uids[(node[utils.GATEWAY_ID], node[utils.NODE_ID])] = node[utils.NODE_UID]
+                self.gateway_nodes.setdefault(node[utils.GATEWAY_ID], set()).add(node[utils.NODE_UID])
+            self._changed()
+
+    def update_nodes(self, node_uids, fields):
+        with self._lock:
+            for node_uid in node_uids:
+                node = self.nodes.get(str(node_uid))
+                if node is not None:
+                    node.update(fields)
+            self._changed()
+
+    def remove_nodes(self, node_uids):
+        with self._lock:
+            for node_uid in node_uids:
+                node = self.nodes.pop(str(node_uid), None)
+                if node is not None:
+                    self.node_uids.pop((node[utils.GATEWAY_ID], node[utils.NODE_ID]), None)
+                    self.gateway_nodes.get(node[utils.GATEWAY_ID], set()).discard(node[utils.NODE_UID])
+            self._changed()
+
+    def _changed(self):
+        self.last_change = time.time()
+        self.version += 1
+
+    def get_gateway_addr(self, gateway_id):
+        with self._lock:
+            return self._count(self.gateway_addrs.get(gateway_id))
+
+    def find_gateway_by_addr(self, addr):
+        with self._lock:
+            return self._count(self.gateway_ids.get(tuple(addr)))
+
+    def get_node(self, node_uid):
+        with self._lock:
+            return self._count(self.nodes.get(str(node_uid)))
+
+    def get_node_uid(self, gateway_id, node_id):
+        with self._lock:
+            return self._count(self.node_uids.get((gateway_id, node_id)))
+
+    def get_nodes(self):
+        with self._lock:
+            self.hits += 1
+            return [dict(node) for node in self.nodes.values()]
+
+    def miss_resolved(self):
+        """Count a miss that was answered by the DB"""
+        with self._lock:
+            self.stale += 1
+
+    def _count(self, value):
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses, 'stale': self.stale,
+                    'hit_rate': self.hits / lookups if lookups else 0.0,
+                    'gateways': len(self.gateway_addrs), 'nodes': len(self.nodes),
+                    'age': time.time() - self.last_change, 'version': self.version}
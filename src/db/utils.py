@@ -54,6 +54,26 @@ DATE = 'date'
 NODE_UIDS = 'node_uids'
 NODE_IDS = 'node_ids'
 
+UPLOAD_ID = 'upload_id'
+UPLOAD_OFFSET = 'offset'
+UPLOAD_SIZE = 'size'
+UPLOAD_RESTART = 'restart'
+CHUNK_CRC32 = 'crc32'
+CHUNK_DATA = 'chunk'
+
+COMPRESS = 'compress'
+LOG_OFFSET = 'offset'
+LOG_LENGTH = 'length'
+
+
+def new_version():
+    """Initial value of a version counter
+
+    Counters start from the current time in microseconds, so versions handed out before a restart are
+    not reused after it.
+    """
+    return int(datetime.utcnow().timestamp() * 1000000)
+
 
 def hash_password(password):
     return bcrypt.hashpw(password.encode(), bcrypt.gensalt())
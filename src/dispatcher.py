@@ -0,0 +1,80 @@
+import concurrent.futures
+import socket
+import queue
+
+import utils
+
+
+class GatewayJob:
+    """A command sent to a single gateway on behalf of a web request"""
+
+    def __init__(self, request_id, gateway_id, addr, pck, node_uids, upload=None):
+        self.request_id = request_id
+        self.gateway_id = gateway_id
+        self.addr = addr
+        self.pck = pck
+        self.node_uids = node_uids
+        self.upload = upload
+        self.sock = None
+        self.error = None
+
+    def failed(self):
+        """Result entries reporting every node of the job as failed"""
+        return [{'_id': node_uid, 'status': utils.ERROR} for node_uid in self.node_uids]
+
+
+class GatewayDispatcher:
+    """Fan out gateway commands on a bounded pool of worker threads
+
+    Each job uploads its image (if any), connects to the gateway and sends the request packet.
+    Completed jobs are queued and the owning event loop is woken up through `wakeup` so that
+    it can register the connected sockets or report the failures.
+    """
+
+    def __init__(self, max_workers, timeout):
+        self.timeout = timeout
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+        self.done = queue.Queue()
+        self.wakeup, self._wakeup_writer = socket.socketpair()
+        self.wakeup.setblocking(False)
+
+    def dispatch(self, job):
+        self.executor.submit(self.run_job, job)
+
+    def run_job(self, job):
+        try:
+            if job.upload is not None and not job.upload(timeout=self.timeout):
+                raise RuntimeError('Image upload failed')
+            job.sock = socket.create_connection((job.addr[0], job.addr[1]), timeout=self.timeout)
+            job.sock.sendall(job.pck)
+        except Exception as e:
+            job.error = e
+            if job.sock is not None:
+                job.sock.close()
+                job.sock = None
+
+        self.done.put(job)
+        try:
+            self._wakeup_writer.send(b'\0')
+        except OSError:     # Dispatcher already closed
+            pass
+
+    def completed(self):
+        """Return the jobs finished since the last call"""
+        try:
+            while self.wakeup.recv(utils.SOCK_BUFSIZE):
+                pass
+        except BlockingIOError:
+            pass
+
+        jobs = []
+        while True:
+            try:
+                jobs.append(self.done.get_nowait())
+            except queue.Empty:
+                return jobs
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        self.wakeup.close()
+        self._wakeup_writer.close()
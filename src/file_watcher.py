@@ -0,0 +1,101 @@
+import os
+import struct
+import ctypes
+import ctypes.util
+
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+
+_EVENT = struct.Struct('iIII')  # struct inotify_event: wd, mask, cookie, len (followed by the name)
+
+
+class FileWatcher:
+    """Report changes of some files of a directory
+
+    With inotify (Linux) the watcher has a file descriptor the owner adds to its select loop and
+    `changed()` is called when it is readable. Without it, `changed()` compares the files stat and the
+    owner calls it periodically. The directory is watched rather than the files, so that files replaced
+    by a rename (as most editors save) are still reported.
+    """
+
+    def __init__(self, path, file_names, use_inotify=True):
+        self.path = path
+        self.file_names = set(file_names)
+        self.fd = None
+        self._stats = {file_name: self._stat(file_name) for file_name in self.file_names}
+
+        if use_inotify:
+            try:
+                self.fd = self._inotify_watch(path)
+            except OSError as e:
+                print('[FileWatcher] inotify not available, polling instead:', e)
+
+    @property
+    def inotify(self):
+        return self.fd is not None
+
+    def fileno(self):
+        return self.fd
+
+    def changed(self):
+        """Return the names of the watched files changed since the last call"""
+        if self.inotify:
+            return self._read_events()
+
+        changed = set()
+        for file_name in self.file_names:
+            stat = self._stat(file_name)
+            if stat != self._stats[file_name]:
+                self._stats[file_name] = stat
+                changed.add(file_name)
+        return changed
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def _stat(self, file_name):
+        try:
+            stat = os.stat(os.path.join(self.path, file_name))
+            return stat.st_mtime_ns, stat.st_size
+        except OSError:
+            return None
+
+    def _read_events(self):
+        changed = set()
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return changed
+            offset = 0
+            while offset < len(data):
+                _, mask, _, length = _EVENT.unpack_from(data, offset)
+                offset += _EVENT.size
+                file_name = data[offset:offset + length].rstrip(b'\0').decode(errors='replace')
+                offset += length
+                if mask & IN_Q_OVERFLOW:    # Events were lost
+                    changed |= self.file_names
+                elif file_name in self.file_names:
+                    changed.add(file_name)
+
+    @staticmethod
+    def _inotify_watch(path):
+        libc_name = ctypes.util.find_library('c')
+        if libc_name is None:
+            raise OSError('libc not found')
+        libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError('inotify not supported')
+
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+        if libc.inotify_add_watch(fd, os.fsencode(path), IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+            errno = ctypes.get_errno()
+            os.close(fd)
+            raise OSError(errno, os.strerror(errno))
+        return fd
@@ -1,22 +1,174 @@
 import ftplib
 import os
+import threading
+import time
 
 import settings
+import utils
+
+
+FTP_KEEPALIVE = 30              # Idle seconds after which a pooled session is checked with NOOP before reuse
+FTP_MAX_IDLE = 300              # Idle seconds after which a pooled session is closed
+FTP_MAX_IDLE_SESSIONS = 2       # Idle sessions kept per gateway
+
+# Errors that mean the connection itself is broken
+CONNECTION_ERRORS = (OSError, EOFError, ftplib.error_temp, ftplib.error_reply, ftplib.error_proto)
+
+
+class Session:
+    """Logged in FTP connection to a gateway"""
+
+    def __init__(self, gateway_ip, timeout=None):
+        self.gateway_ip = gateway_ip
+        self.ftp = ftplib.FTP(host=gateway_ip, user=settings.FTP_USERNAME, passwd=settings.FTP_PASSWORD,
+                              timeout=timeout)
+        self.home = self.ftp.pwd()
+        self.last_used = time.time()
+        self.reused = False
+        self.dirs = set()   # Directories known to exist, relative to home
+
+    def set_timeout(self, timeout):
+        self.ftp.timeout = timeout
+        self.ftp.sock.settimeout(timeout)
+
+    def is_alive(self):
+        try:
+            self.ftp.voidcmd('NOOP')
+            return True
+        except CONNECTION_ERRORS:
+            return False
+
+    def close(self):
+        try:
+            self.ftp.quit()
+        except CONNECTION_ERRORS:
+            self.ftp.close()
+
+
+class FTPPool:
+    """Pool of FTP sessions per gateway
+
+    Sessions are reused across transfers so that batched uploads need a single login. A session idle
+    for more than `keepalive` seconds is checked with NOOP before reuse and one idle for more than
+    `max_idle` seconds is closed. An operation that fails on a pooled session is retried once on a
+    new connection.
+    """
+
+    def __init__(self, keepalive=FTP_KEEPALIVE, max_idle=FTP_MAX_IDLE, max_idle_sessions=FTP_MAX_IDLE_SESSIONS):
+        self.keepalive = keepalive
+        self.max_idle = max_idle
+        self.max_idle_sessions = max_idle_sessions
+        self._idle = {}     # {gateway_ip: [Session]}
+        self._lock = threading.Lock()
+
+    def run(self, gateway_ip, operation, timeout=None):
+        """Call operation(session) on a session to the gateway and return its result"""
+        session = self._acquire(gateway_ip, timeout)
+        try:
+            return self._run(session, operation)
+        except CONNECTION_ERRORS:
+            if not session.reused:
+                raise
+        # The pooled connection went bad while idle, reconnect and retry once
+        return self._run(self._acquire(gateway_ip, timeout, reuse=False), operation)
+
+    def _run(self, session, operation):
+        try:
+            result = operation(session)
+        except ftplib.error_perm:   # Permanent reply error, the connection is still usable
+            self._release(session)
+            raise
+        except BaseException:
+            session.close()
+            raise
+
+        self._release(session)
+        return result
+
+    def _acquire(self, gateway_ip, timeout, reuse=True):
+        self.evict_idle()
+        while reuse:
+            with self._lock:
+                sessions = self._idle.get(gateway_ip)
+                if not sessions:
+                    break
+                session = sessions.pop()
+            if time.time() - session.last_used < self.keepalive or session.is_alive():
+                session.set_timeout(timeout)
+                session.reused = True
+                return session
+            session.close()
+
+        return Session(gateway_ip, timeout)
+
+    def _release(self, session):
+        try:
+            session.ftp.cwd(session.home)
+        except CONNECTION_ERRORS + (ftplib.error_perm,):
+            session.close()
+            return
+
+        session.last_used = time.time()
+        with self._lock:
+            sessions = self._idle.setdefault(session.gateway_ip, [])
+            if len(sessions) < self.max_idle_sessions:
+                sessions.append(session)
+                return
+        session.close()
+
+    def evict_idle(self):
+        now = time.time()
+        expired = []
+        with self._lock:
+            for gateway_ip, sessions in list(self._idle.items()):
+                expired.extend(session for session in sessions if now - session.last_used > self.max_idle)
+                sessions[:] = [session for session in sessions if now - session.last_used <= self.max_idle]
+                if not sessions:
+                    del self._idle[gateway_ip]
+        for session in expired:
+            session.close()
+
+    def close_gateway(self, gateway_ip):
+        with self._lock:
+            sessions = self._idle.pop(gateway_ip, [])
+        for session in sessions:
+            session.close()
+
+    def close(self):
+        with self._lock:
+            sessions = [session for _sessions in self._idle.values() for session in _sessions]
+            self._idle.clear()
+        for session in sessions:
+            session.close()
+
+
+pool = FTPPool()
+
+_uploaded = {}  # Images each gateway already has {gateway_ip: {remote path: sha256}}
+_uploaded_lock = threading.Lock()
+
+
+def forget_gateway(gateway_ip):
+    """Drop what is known about the images of a gateway, e.g. after it (re)registers"""
+    with _uploaded_lock:
+        _uploaded.pop(gateway_ip, None)
 
 
 def upload_file(gateway_ip, path, file_name):
+    def _upload_file(session):
+        with open(path + file_name, 'rb') as f:
+            res = session.ftp.storbinary('STOR %s' % file_name, f)
+            res_format = res.split('\n')[0].split('-')
+            res_code = res_format[0]
+            '''
+            if res_code == '226':
+                print(res_format[1] + ' [%s]' % filename)
+            else:
+                print(res)
+            '''
+
     try:
-        with ftplib.FTP(host=gateway_ip, user=settings.FTP_USERNAME, passwd=settings.FTP_PASSWORD) as _ftp:
-            with open(path + file_name, 'rb') as f:
-                res = _ftp.storbinary('STOR %s' % file_name, f)
-                res_format = res.split('\n')[0].split('-')
-                res_code = res_format[0]
-                '''
-                if res_code == '226':
-                    print(res_format[1] + ' [%s]' % filename)
-                else:
-                    print(res)
-                '''
+        pool.run(gateway_ip, _upload_file)
     except ftplib.error_perm as e:  # Error codes 500-599
         if e.args[0][0:3] == '530':
             print('[Upload_file] Login authentication failed')
@@ -26,25 +178,32 @@ def upload_file(gateway_ip, path, file_name):
             print(e.args[0])
 
 
-def upload_image(gateway_ip, image_name, user_id, nodetype):
+def upload_image(gateway_ip, image_name, user_id, nodetype, timeout=None):
+    """Upload a user image to a gateway, return True on success"""
     binary_file = os.path.dirname(os.path.abspath(__file__)) + '/images/' + user_id + '/' + nodetype + '/' + image_name
+    if nodetype == 'UNO':
+        remote_dir = 'images/' + image_name.split('.')[0]
+    else:
+        remote_dir = 'images'
+
+    # Skip the transfer when the gateway already has this exact image
+    digest = utils.image_digest(binary_file)
+    with _uploaded_lock:
+        if _uploaded.get(gateway_ip, {}).get(remote_dir + '/' + image_name) == digest:
+            return True
+
+    def _upload_image(session):
+        with open(binary_file, 'rb') as f:
+            mkdirs(session, remote_dir)
+            res = session.ftp.storbinary('STOR %s' % image_name, f)
+            res_format = res.split('\n')[0].split('-')
+            res_code = res_format[0]
+
     try:
-        with ftplib.FTP(host=gateway_ip, user=settings.FTP_USERNAME, passwd=settings.FTP_PASSWORD) as _ftp:
-            with open(binary_file, 'rb') as f:
-                if not directory_exists(_ftp, 'images'):
-                    _ftp.mkd('images')
-                _ftp.cwd('images')
-
-                if nodetype == 'UNO':
-                    _dir = image_name.split('.')[0]
-                    if not directory_exists(_ftp, _dir):
-                        _ftp.mkd(_dir)
-                    _ftp.cwd(_dir)
-                    res = _ftp.storbinary('STOR %s' % image_name, f)
-                else:
-                    res = _ftp.storbinary('STOR %s' % image_name, f)
-                    res_format = res.split('\n')[0].split('-')
-                    res_code = res_format[0]
+        pool.run(gateway_ip, _upload_image, timeout)
+        with _uploaded_lock:
+            _uploaded.setdefault(gateway_ip, {})[remote_dir + '/' + image_name] = digest
+        return True
     except ftplib.error_perm as e:  # Error codes 500-599
         if e.args[0][0:3] == '530':
             print('[Upload_image] Login authentication failed')
@@ -52,34 +211,30 @@ def upload_image(gateway_ip, image_name, user_id, nodetype):
             print('[Upload_image] Bad filename:', e)
         else:
             print(e.args[0])
+        return False
 
 
 def upload_erase_image(gateway_ip, path, image_name):
+    def _upload_erase_image(session):
+        with open(path + image_name, 'rb') as f:
+            _dir, ext = image_name.split('.')
+            if ext == 'ino':
+                mkdirs(session, 'images/erase/' + _dir)
+            else:
+                mkdirs(session, 'images/erase')
+
+            res = session.ftp.storbinary('STOR %s' % image_name, f)
+            res_format = res.split('\n')[0].split('-')
+            res_code = res_format[0]
+            '''
+            if res_code == '226':
+                print(res_format[1] + ' [%s]' % filename)
+            else:
+                print(res)
+            '''
+
     try:
-        with ftplib.FTP(host=gateway_ip, user=settings.FTP_USERNAME, passwd=settings.FTP_PASSWORD) as _ftp:
-            with open(path + image_name, 'rb') as f:
-                if not directory_exists(_ftp, 'images'):
-                    _ftp.mkd('images')
-                _ftp.cwd('images')
-                if not directory_exists(_ftp, 'erase'):
-                    _ftp.mkd('erase')
-                _ftp.cwd('erase')
-
-                _dir, ext = image_name.split('.')
-                if ext == 'ino':
-                    if not directory_exists(_ftp, _dir):
-                        _ftp.mkd(_dir)
-                    _ftp.cwd(_dir)
-
-                res = _ftp.storbinary('STOR %s' % image_name, f)
-                res_format = res.split('\n')[0].split('-')
-                res_code = res_format[0]
-                '''
-                if res_code == '226':
-                    print(res_format[1] + ' [%s]' % filename)
-                else:
-                    print(res)
-                '''
+        pool.run(gateway_ip, _upload_erase_image)
     except ftplib.error_perm as e:  # Error codes 500-599
         if e.args[0][0:3] == '530':
             print('[Upload_erase_image] Login authentication failed')
@@ -90,18 +245,19 @@ def upload_erase_image(gateway_ip, path, image_name):
 
 
 def download_xml(gateway_ip, gateways_xml_dir, file_name):
-    try:
-        with ftplib.FTP(host=gateway_ip, user=settings.FTP_USERNAME, passwd=settings.FTP_PASSWORD) as _ftp:
-            with open(gateways_xml_dir + file_name, 'wb') as f:
-                res = _ftp.retrbinary('RETR %s' % file_name, f.write)
-                res_format = res.split('\n')[0].split('-')
-                res_code = res_format[0]
+    def _download_xml(session):
+        with open(gateways_xml_dir + file_name, 'wb') as f:
+            res = session.ftp.retrbinary('RETR %s' % file_name, f.write)
+            res_format = res.split('\n')[0].split('-')
+            res_code = res_format[0]
 
-                if res_code == '226':
-                    print(res_format[1] + ' [%s]' % file_name)
-                else:
-                    print(res)
+            if res_code == '226':
+                print(res_format[1] + ' [%s]' % file_name)
+            else:
+                print(res)
 
+    try:
+        pool.run(gateway_ip, _download_xml)
     except ftplib.error_perm as e:      # Error codes 500-599
         if e.args[0][0:3] == '530':
             print('[Download_xml] Login authentication failed')
@@ -111,10 +267,41 @@ def download_xml(gateway_ip, gateways_xml_dir, file_name):
             print(e.args[0])
 
 
-def directory_exists(_ftp, _dir):
-    filelist = []
-    _ftp.retrlines('LIST', filelist.append)
-    for f in filelist:
-        if f.split()[-1] == _dir and f.upper().startswith('D'):
-            return True
-    return False
+def get_file_info(gateway_ip, file_name):
+    """Size and modification time of a file on the gateway, None if the server cannot tell"""
+    def _get_file_info(session):
+        session.ftp.voidcmd('TYPE I')   # SIZE is the byte size only in binary mode
+        size = session.ftp.size(file_name)
+        mdtm = session.ftp.voidcmd('MDTM %s' % file_name)[4:].strip()
+        return size, mdtm
+
+    try:
+        return pool.run(gateway_ip, _get_file_info)
+    except ftplib.error_perm:   # Missing file or SIZE/MDTM not supported
+        return None
+
+
+def mkdirs(session, path):
+    """Change into path (relative to the session home), creating the missing directories
+
+    Directories are created with MKD and a 550 reply (already exists) is ignored. Created and visited
+    directories are cached per session, so a known path costs a single CWD and no LIST.
+    """
+    if path in session.dirs:
+        try:
+            session.ftp.cwd(path)
+            return
+        except ftplib.error_perm:   # Removed on the gateway since it was cached
+            session.dirs.clear()
+
+    current = ''
+    for _dir in path.split('/'):
+        current = current + '/' + _dir if current else _dir
+        if current not in session.dirs:
+            try:
+                session.ftp.mkd(_dir)
+            except ftplib.error_perm as e:
+                if e.args[0][0:3] != '550':
+                    raise
+        session.ftp.cwd(_dir)
+        session.dirs.add(current)
@@ -1,14 +1,29 @@
+import db.utils as utils
+
+
 class Gateway:
     """Gateway class"""
 
+    __slots__ = ('_id', 'addr')
+
     def __init__(self, _id, addr):
         self._id = _id
         self.addr = addr
 
+    def to_document(self):
+        """Gateway document as stored in the gateways collection"""
+        return {utils.GATEWAY_UID: self._id, utils.GATEWAY_ADDRESS: list(self.addr)}
+
+    @classmethod
+    def from_document(cls, document):
+        return cls(document[utils.GATEWAY_UID], tuple(document[utils.GATEWAY_ADDRESS]))
+
 
 class GatewayInfo:
     """GatewayInfo class"""
 
+    __slots__ = ('id', 'seed', 'timer')
+
     def __init__(self, _id, start_time):
         self.id = _id
         self.seed = 0
@@ -0,0 +1,119 @@
+import threading
+import time
+
+
+class LogWriter(threading.Thread):
+    """Experiment log writer, off the web loop
+
+    The log file stays open while the experiment runs. Lines are buffered and written in one go when
+    the buffer holds `max_size` bytes or its oldest line is `max_delay` seconds old, so a reader of
+    the log sees the lines at most `max_delay` seconds late. Opening, closing and clearing a log are
+    applied in order with the lines, as soon as they are requested.
+    """
+
+    def __init__(self, max_size, max_delay):
+        threading.Thread.__init__(self, daemon=True)
+        self.max_size = max_size
+        self.max_delay = max_delay
+
+        self._pending = []      # [(operation, argument)]
+        self._size = 0          # Bytes of the pending lines
+        self._oldest = None     # When the oldest pending line was queued
+        self._commands = 0      # Pending operations other than writes
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._file = None
+
+    def open(self, path):
+        """Switch to the log at path, lines are appended to it"""
+        self._queue('open', path)
+
+    def close(self):
+        self._queue('close', None)
+
+    def clear(self, path):
+        """Erase the contents of the log at path"""
+        self._queue('clear', path)
+
+    def write(self, text):
+        with self._cond:
+            self._pending.append(('write', text))
+            self._size += len(text)
+            if self._oldest is None:    # The writer waits for a first line to set its timeout
+                self._oldest = time.monotonic()
+                self._cond.notify()
+            elif self._size >= self.max_size:
+                self._cond.notify()
+
+    def stop(self):
+        """Write what is pending, close the log and end the thread"""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+
+    def _queue(self, operation, argument):
+        with self._cond:
+            self._pending.append((operation, argument))
+            self._commands += 1
+            self._cond.notify()
+
+    def _wait_time(self):
+        """Seconds to wait before the pending lines are due, 0 if they are, None if there are none"""
+        if self._commands or self._size >= self.max_size:
+            return 0
+        if self._oldest is None:
+            return None
+        return max(0, self._oldest + self.max_delay - time.monotonic())
+
+    def run(self):
+        while True:
+            with self._cond:
+                timeout = self._wait_time()
+                while timeout != 0 and not self._stopped:
+                    self._cond.wait(timeout)
+                    timeout = self._wait_time()
+                pending = self._pending
+                self._pending = []
+                self._size = 0
+                self._oldest = None
+                self._commands = 0
+                stopped = self._stopped
+
+            try:
+                self._apply(pending)
+            except OSError as e:
+                print('[LogWriter]', e)
+            if stopped:
+                self._close()
+                return
+
+    def _apply(self, pending):
+        lines = []
+        for operation, argument in pending:
+            if operation == 'write':
+                lines.append(argument)
+                continue
+
+            self._write(lines)
+            lines = []
+            if operation == 'open':
+                self._close()
+                self._file = open(argument, 'a')
+            elif operation == 'close':
+                self._close()
+            elif operation == 'clear':
+                if self._file is not None and self._file.name == argument:
+                    self._file.truncate(0)
+                else:
+                    open(argument, 'w').close()
+        self._write(lines)
+
+    def _write(self, lines):
+        if lines and self._file is not None:
+            self._file.write(''.join(lines))
+            self._file.flush()
+
+    def _close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
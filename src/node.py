@@ -1,13 +1,46 @@
+import sys
+
 import db.utils as utils
 
 
+_locations = {}     # Interned locations {location: location}
+
+
+def intern_location(items):
+    """Shared, immutable location from its (tag, value) items, e.g. building, floor and area
+
+    Nodes with the same location share one tuple and its strings, so a large descriptor costs one
+    location per distinct place rather than one dict per node.
+    """
+    location = tuple((sys.intern(tag), sys.intern(value) if value is not None else None) for tag, value in items)
+    return _locations.setdefault(location, location)
+
+
 class Node:
     """Node class"""
 
+    __slots__ = ('id', 'nodetype_id', 'gateway_id', 'image_name', 'flashed', 'location')
+
     def __init__(self, _id, nodetype_id, location):
+        """location is a tuple of (tag, value) items, see intern_location"""
         self.id = _id
         self.nodetype_id = nodetype_id
         self.gateway_id = None
         self.image_name = None
         self.flashed = utils.FLASH_NOT_STARTED
         self.location = location
+
+    def to_document(self):
+        """Node document as stored in the nodes collection"""
+        return {utils.NODE_ID: self.id, utils.NODETYPE_ID: self.nodetype_id, utils.GATEWAY_ID: self.gateway_id,
+                utils.IMAGE_NAME: self.image_name, utils.NODE_FLASHED: self.flashed,
+                utils.LOCATION: dict(self.location)}
+
+    @classmethod
+    def from_document(cls, document):
+        node = cls(document[utils.NODE_ID], document[utils.NODETYPE_ID],
+                   intern_location(document[utils.LOCATION].items()))
+        node.gateway_id = document.get(utils.GATEWAY_ID)
+        node.image_name = document.get(utils.IMAGE_NAME)
+        node.flashed = document.get(utils.NODE_FLASHED, utils.FLASH_NOT_STARTED)
+        return node
@@ -0,0 +1,144 @@
+import os
+import threading
+import collections
+import logging
+
+import gateway
+import ftp
+import utils
+
+
+class RegistrationWorker(threading.Thread):
+    """Gateway registration and resync, off the heartbeat loop
+
+    The heartbeat loop only enqueues work. Jobs are coalesced per gateway: while a gateway has a job
+    waiting, newer requests for it update that job instead of queueing another one. Pending
+    deletions are applied in one batch, before the pending registrations and file pushes.
+
+    The last descriptor processed for each gateway is remembered, so that a resync of an unchanged
+    descriptor skips the download (same SIZE and MDTM) or the parse and DB sync (same SHA-256).
+    """
+
+    def __init__(self, db_connector, parser, gateways_xml_dir):
+        threading.Thread.__init__(self, daemon=True)
+        self.dbConnector = db_connector
+        self.parser = parser
+        self.gateways_xml_dir = gateways_xml_dir
+        self.logger = logging.getLogger('server')
+
+        self._pending = collections.OrderedDict()   # {gateway_id: {delete, register, files}}
+        self._xml_info = {}     # Last processed descriptor {gateway_id: (remote (size, mdtm), sha256)}
+        self._cond = threading.Condition()
+        self._stopped = False
+
+    def register(self, _id, gateway_ip, ip, port, create):
+        """Download and store the gateway descriptor, create the gateway if `create`"""
+        with self._cond:
+            job = self._pending.setdefault(_id, {'delete': False, 'register': None, 'files': set()})
+            if job['register'] is not None:
+                create = create or job['register']['create']
+            job['register'] = {'gateway_ip': gateway_ip, 'ip': ip, 'port': port, 'create': create}
+            self._cond.notify()
+
+    def delete(self, _ids):
+        with self._cond:
+            for _id in _ids:
+                # A registration still waiting for an expired gateway is not needed any more
+                self._pending[_id] = {'delete': True, 'register': None, 'files': set()}
+            self._cond.notify()
+
+    def push_file(self, _ids, file_name):
+        """Upload one of the shared files (nodetypes, locations) to the gateways"""
+        with self._cond:
+            for _id in _ids:
+                job = self._pending.setdefault(_id, {'delete': False, 'register': None, 'files': set()})
+                if not job['delete']:
+                    job['files'].add(file_name)
+            self._cond.notify()
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+
+    def run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._stopped:
+                    self._cond.wait()
+                if self._stopped:
+                    return
+                jobs = self._pending
+                self._pending = collections.OrderedDict()
+
+            delete_ids = [_id for _id, job in jobs.items() if job['delete']]
+            if delete_ids:
+                for _id in delete_ids:
+                    self._xml_info.pop(_id, None)
+                try:
+                    for addr in self.dbConnector.get_gateways_addr(delete_ids).values():
+                        ftp.pool.close_gateway(addr[0])
+                    self.dbConnector.delete_gateways(delete_ids)
+                except Exception as e:
+                    self.logger.exception('%s deletion failed: %s' % (delete_ids, e))
+
+            for _id, job in jobs.items():
+                if job['register'] is not None:
+                    try:
+                        self.register_gateway(_id, **job['register'])
+                    except Exception as e:
+                        self.logger.exception('[%s] registration failed: %s' % (_id, e))
+                    if job['register']['create']:
+                        continue    # A new gateway gets every shared file
+                if job['files']:
+                    try:
+                        self.push_files(_id, job['files'])
+                    except Exception as e:
+                        self.logger.exception('[%s] %s upload failed: %s' % (_id, sorted(job['files']), e))
+
+    def register_gateway(self, _id, gateway_ip, ip, port, create):
+        xml_filename = _id + '.xml'
+        remote_info = ftp.get_file_info(gateway_ip, xml_filename)
+        prev_remote_info, prev_digest = self._xml_info.get(_id, (None, None))
+        if not create and remote_info is not None and remote_info == prev_remote_info and \
+                os.path.isfile(self.gateways_xml_dir + xml_filename):
+            self.logger.debug('[%s] descriptor not modified' % _id)
+            return
+
+        ftp.download_xml(gateway_ip, self.gateways_xml_dir, xml_filename)
+        digest = utils.file_digest(self.gateways_xml_dir + xml_filename)
+        if not create and digest == prev_digest:
+            self.logger.debug('[%s] descriptor unchanged' % _id)
+            self._xml_info[_id] = (remote_info, digest)
+            return
+
+        _gateway = gateway.Gateway(_id, (ip, port))
+        gateway_location, nodes = self.parser.get_xml_info(self.gateways_xml_dir + xml_filename)
+        for node in nodes:
+            node.gateway_id = _id
+
+        if create:     # ( Send_seed = 1 ) > ( local_seed = 0 )
+            self.dbConnector.insert_gateway(_gateway, gateway_location, nodes)
+            ftp.forget_gateway(ip)  # The gateway may have restarted without its images
+            ftp.pool.close_gateway(ip)  # and the pooled sessions to it are stale
+            # self.dbConnector.update_gateway_location(_id, gateway_location)
+            ftp.upload_file(ip, os.path.dirname(os.path.abspath(__file__)) + '/', utils.NODETYPES_FILE)
+            ftp.upload_file(ip, os.path.dirname(os.path.abspath(__file__)) + '/', utils.LOCATIONS_FILE)
+            self.upload_erase_images(ip)
+        else:
+            self.dbConnector.update_gateway_nodes(_gateway, nodes)
+        self._xml_info[_id] = (remote_info, digest)
+
+    def push_files(self, _id, file_names):
+        addr = self.dbConnector.get_gateway_addr(_id)
+        if addr is None:    # Alive but not registered (yet), it gets every file when it is
+            return
+        for file_name in file_names:
+            ftp.upload_file(addr[0], os.path.dirname(os.path.abspath(__file__)) + '/', file_name)
+
+    @staticmethod
+    def upload_erase_images(ip):
+        path = os.path.dirname(os.path.abspath(__file__)) + '/' + utils.ERASE_IMAGES_PATH + '/'
+        erase_images = [f for f in os.listdir(path) if os.path.isfile(os.path.join(path, f))]
+        for image in erase_images:
+            ftp.upload_erase_image(ip, path, image)
@@ -0,0 +1,114 @@
+import heapq
+import itertools
+import random
+import time
+
+
+class Task:
+    """Periodic or one-shot task of a Scheduler"""
+
+    def __init__(self, name, function, args, interval=None, jitter=0.0):
+        self.name = name
+        self.function = function
+        self.args = args
+        self.interval = interval    # None for one-shot tasks
+        self.jitter = jitter
+        self.cancelled = False
+
+        self.runs = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.missed = 0             # Runs that started more than one interval late
+        self.max_lateness = 0.0
+
+    def cancel(self):
+        self.cancelled = True
+
+    def stats(self):
+        return {'runs': self.runs, 'avg_time': self.total_time / self.runs if self.runs else 0.0,
+                'max_time': self.max_time, 'missed': self.missed, 'max_lateness': self.max_lateness}
+
+
+class Scheduler:
+    """Deadline scheduler on the monotonic clock, driven by the owning select loop
+
+    The loop waits for at most `next_timeout()` seconds and then calls `run_pending()`. Task names are
+    unique, registering a task cancels the pending one with the same name.
+    """
+
+    def __init__(self, logger):
+        self.logger = logger
+        self.tasks = {}     # {name: Task}
+        self._heap = []     # [(deadline, seq, Task)]
+        self._seq = itertools.count()
+
+    def call_every(self, interval, function, *args, name=None, jitter=0.0):
+        """Run function(*args) every `interval` seconds (plus up to `jitter` seconds)
+
+        The first run is one interval from now.
+        """
+        task = Task(name or function.__name__, function, args, interval, jitter)
+        self._add(task, time.monotonic() + interval)
+        return task
+
+    def call_later(self, delay, function, *args, name=None):
+        """Run function(*args) once, after `delay` seconds"""
+        task = Task(name or function.__name__, function, args)
+        self._add(task, time.monotonic() + delay)
+        return task
+
+    def next_timeout(self):
+        """Seconds until the next deadline, None if there is nothing scheduled"""
+        while self._heap and self._heap[0][2].cancelled:
+            heapq.heappop(self._heap)
+        if not self._heap:
+            return None
+        return max(0, self._heap[0][0] - time.monotonic())
+
+    def run_pending(self):
+        now = time.monotonic()
+        while self._heap and self._heap[0][0] <= now:
+            deadline, _, task = heapq.heappop(self._heap)
+            if task.cancelled:
+                continue
+
+            lateness = now - deadline
+            task.max_lateness = max(task.max_lateness, lateness)
+            if task.interval is not None and lateness > task.interval:
+                task.missed += 1
+                self.logger.warning('Task [%s] missed its deadline by %.3fs' % (task.name, lateness))
+
+            start = time.monotonic()
+            try:
+                task.function(*task.args)
+            except Exception as e:
+                self.logger.exception('Task [%s] failed: %s' % (task.name, e))
+            elapsed = time.monotonic() - start
+            task.runs += 1
+            task.total_time += elapsed
+            task.max_time = max(task.max_time, elapsed)
+
+            if task.interval is None:
+                if self.tasks.get(task.name) is task:
+                    del self.tasks[task.name]
+            elif not task.cancelled:
+                next_deadline = deadline + task.interval
+                if next_deadline <= now:    # Do not try to catch up on the missed runs
+                    next_deadline = now + task.interval
+                self._push(task, next_deadline + random.uniform(0, task.jitter))
+
+    def stats(self):
+        return {name: task.stats() for name, task in self.tasks.items()}
+
+    def cancel(self, name):
+        task = self.tasks.pop(name, None)
+        if task is not None:
+            task.cancel()
+
+    def _add(self, task, deadline):
+        self.cancel(task.name)
+        self.tasks[task.name] = task
+        self._push(task, deadline)
+
+    def _push(self, task, deadline):
+        heapq.heappush(self._heap, (deadline, next(self._seq), task))
@@ -6,7 +6,8 @@ import time
 import threading
 import configparser
 import logging.config
-from operator import attrgetter
+import heapq
+import itertools
 
 import xml_handler
 import gateway
@@ -14,7 +15,9 @@ import ftp
 import utils
 from db import db_connector
 import web_handler
-import timeoutwatch
+import registration
+import scheduler
+import file_watcher
 
 
 class Server:
@@ -23,33 +26,44 @@ class Server:
     def __init__(self, gateways_xml_dir, config):
         self.gateways_xml_dir = gateways_xml_dir
         self.gateways_info = {}
+        self.gateways_deadlines = []    # Heap of (deadline, seq, GatewayInfo), refreshed lazily on expiry
+        self._deadline_seq = itertools.count()
         self._stop_thread_event = threading.Event()
 
         logging.config.fileConfig(os.path.dirname(os.path.abspath(__file__)) + '/' + 'logging.conf')
         self.logger = logging.getLogger('server')
 
         self.server_cfg = self.read_config(config)
-        self.timeouts = [timeoutwatch.TimeoutWatch(float(self.server_cfg['timeout_gateway'])),
-                         timeoutwatch.TimeoutWatch(float(self.server_cfg['timeout_nodetypes'])),
-                         timeoutwatch.TimeoutWatch(float(self.server_cfg['timeout_locations']))]
-
-        try:
-            self.nodetypesMtime = os.path.getmtime(os.path.dirname(os.path.abspath(__file__)) + '/' +
-                                                   utils.NODETYPES_FILE)
-            self.locationsMtime = os.path.getmtime(os.path.dirname(os.path.abspath(__file__)) + '/' +
-                                                   utils.LOCATIONS_FILE)
+        self.timer_gateway = float(self.server_cfg['timer_gateway'])
+        self.scheduler = scheduler.Scheduler(self.logger)
+        self.scheduler.call_every(float(self.server_cfg['timeout_gateway']), self.check_gateways_timers)
+        self.files_debounce = float(self.server_cfg['timeout_files_debounce'])
+
+        try:    # Digests of the shared files, they are pushed to the gateways only when their content changes
+            self.files_digests = {file_name: utils.file_digest(os.path.dirname(os.path.abspath(__file__)) + '/'
+                                                               + file_name)
+                                  for file_name in (utils.NODETYPES_FILE, utils.LOCATIONS_FILE)}
         except OSError as e:
             sys.exit(e)
+        self.files_watcher = file_watcher.FileWatcher(os.path.dirname(os.path.abspath(__file__)),
+                                                      self.files_digests,
+                                                      self.server_cfg['watch_inotify'] == 'yes')
+        if not self.files_watcher.inotify:
+            self.scheduler.call_every(min(float(self.server_cfg['timeout_nodetypes']),
+                                          float(self.server_cfg['timeout_locations'])), self.check_files)
 
         self.dbConnector = db_connector.DBConnector(self.server_cfg['db_ip'], int(self.server_cfg['db_port']))
         if not self.dbConnector.check_connection():
             sys.exit('Could not connect to DB')
-        self.dbConnector.insert_nodetypes(os.path.dirname(os.path.abspath(__file__)) + '/' + utils.NODETYPES_FILE)
+        self.dbConnector.load_topology()
+        self.dbConnector.sync_nodetypes(os.path.dirname(os.path.abspath(__file__)) + '/' + utils.NODETYPES_FILE)
 
         self.sock_udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.sock_udp.bind((self.server_cfg['public_ip'], int(self.server_cfg['public_port'])))
 
         self.parser = xml_handler.XmlParser()
+        self.registration = registration.RegistrationWorker(self.dbConnector, self.parser, self.gateways_xml_dir)
+        self.registration.start()
 
         self._web_handler = web_handler.WebHandler(self.dbConnector, self.server_cfg, self._stop_thread_event)
         self._web_handler.start()
@@ -74,83 +88,82 @@ class Server:
 
     def run_forever(self):
         inputs = [self.sock_udp]
-
-        for timeout in self.timeouts:
-            timeout.start()
+        if self.files_watcher.inotify:
+            inputs.append(self.files_watcher)
 
         while inputs:
             try:
-                self.check_timeouts()
-                new_timeout = self.get_next_timeout()
-                readable, writable, exceptional = select.select(inputs, [], inputs, new_timeout)
+                self.scheduler.run_pending()
+                readable, writable, exceptional = select.select(inputs, [], inputs, self.scheduler.next_timeout())
 
                 for s in readable:
                     if s is self.sock_udp:
                         rcv_pck, gateway_addr = self.sock_udp.recvfrom(1024)
                         self.handle_isalive_gateway(rcv_pck, gateway_addr[0])
+                    elif s is self.files_watcher:
+                        self.check_files()
                 for s in exceptional:
                     if s is self.sock_udp:
                         inputs.remove(self.sock_udp)
                         self.sock_udp.close()
             except KeyboardInterrupt:
                 self.logger.debug('Exiting. . .')
+                self.logger.debug('Scheduler %s' % self.scheduler.stats())
                 self.sock_udp.close()
+                self.files_watcher.close()
+                self.registration.stop()
+                ftp.pool.close()
                 self.stop_thread()
                 self._web_handler.join()
                 sys.exit('Exiting. . .')
 
-    def check_timeouts(self):
-        for num, timeout in enumerate(self.timeouts):
-            if timeout.time_remaining < 0:
-                if num == 0:
-                    self.check_gateways_timers()
-                elif num == 1:
-                    res = self.check_last_modified(utils.NODETYPES_FILE)
-                    if res:
-                        self.dbConnector.insert_nodetypes(os.path.dirname(os.path.abspath(__file__)) + '/'
-                                                          + utils.NODETYPES_FILE)
-                        self.send_file_to_gateways(utils.NODETYPES_FILE)
-                else:
-                    res = self.check_last_modified(utils.LOCATIONS_FILE)
-                    if res:
-                        self.send_file_to_gateways(utils.LOCATIONS_FILE)
-                timeout.refresh()
+    def check_files(self):
+        # Editors often write a file in several steps, wait for the burst to settle before reloading
+        for file_name in self.files_watcher.changed():
+            self.scheduler.call_later(self.files_debounce, self.reload_file, file_name, name='reload ' + file_name)
+
+    def reload_file(self, file_name):
+        try:
+            digest = utils.file_digest(os.path.dirname(os.path.abspath(__file__)) + '/' + file_name)
+        except OSError as e:    # Replaced in the middle of the reload, the next event triggers it again
+            print(e)
+            return
+        if digest == self.files_digests[file_name]:
+            return
+        self.files_digests[file_name] = digest
+
+        self.logger.info('%s changed' % file_name)
+        path = os.path.dirname(os.path.abspath(__file__)) + '/' + file_name
+        if file_name == utils.NODETYPES_FILE and self.dbConnector.sync_nodetypes(path):
+            self.logger.info('Nodetypes updated')
+        self.send_file_to_gateways(file_name)
 
     def check_gateways_timers(self):
+        """Expire the gateways whose last ISALIVE is older than `timer_gateway`
+
+        Only the heap entries whose deadline has passed are examined. An entry of a gateway that
+        sent an ISALIVE since it was pushed is pushed again with the new deadline.
+        """
+        now = time.monotonic()
         gateway_ids_to_delete = []
-        for _gateway in self.gateways_info:
-            if time.time() - self.gateways_info[_gateway].timer > float(self.server_cfg['timer_gateway']):
-                gateway_ids_to_delete.append(_gateway)
+        while self.gateways_deadlines and self.gateways_deadlines[0][0] < now:
+            _, _, gateway_info = heapq.heappop(self.gateways_deadlines)
+            if self.gateways_info.get(gateway_info.id) is not gateway_info:
+                continue    # Already expired
+            deadline = gateway_info.timer + self.timer_gateway
+            if deadline < now:
+                del self.gateways_info[gateway_info.id]
+                gateway_ids_to_delete.append(gateway_info.id)
+            else:
+                self.push_gateway_deadline(gateway_info, deadline)
         if gateway_ids_to_delete:
-            for gateway_id in gateway_ids_to_delete:
-                _gateway = self.gateways_info.pop(gateway_id, None)
-                if _gateway is not None:
-                    self.dbConnector.delete_gateway(_gateway.id)
-
-    def check_last_modified(self, file_name):
-        try:
-            last_modified = os.path.getmtime(os.path.dirname(os.path.abspath(__file__)) + '/' + file_name)
-            if (file_name == utils.NODETYPES_FILE) and (last_modified > self.nodetypesMtime):
-                self.nodetypesMtime = last_modified
-                return True
-            elif (file_name == utils.LOCATIONS_FILE) and (last_modified > self.locationsMtime):
-                self.locationsMtime = last_modified
-                return True
-            return False
-        except OSError as e:
-            print(e)
-            return False
+            self.registration.delete(gateway_ids_to_delete)
+        self.logger.debug('Topology cache %s' % self.dbConnector.topology.stats())
+        ftp.pool.evict_idle()
 
     def send_file_to_gateways(self, file_name):
-        for _gateway in self.gateways_info:
-            addr = self.dbConnector.get_gateway_addr(self.gateways_info[_gateway].id)
-            ftp.upload_file(addr, os.path.dirname(os.path.abspath(__file__)) + '/', file_name)
-
-    def get_next_timeout(self):
-        _timeout = min(self.timeouts, key=attrgetter('time_remaining'))
-        if _timeout.time_remaining < 0:
-            return 0
-        return _timeout.time_remaining
+        # The uploads run on the registration worker, not to hold up the ISALIVE handling
+        self.registration.push_file(list(self.gateways_info), file_name)
 
     def handle_isalive_gateway(self, pck, gateway_ip):
         flag_create = False
@@ -158,28 +171,17 @@ class Server:
 
         if _id not in self.gateways_info:
             flag_create = True
-            self.gateways_info[_id] = gateway.GatewayInfo(_id, time.time())
+            self.gateways_info[_id] = gateway.GatewayInfo(_id, time.monotonic())
+            self.push_gateway_deadline(self.gateways_info[_id], self.gateways_info[_id].timer + self.timer_gateway)
 
         flag_update = self.check_seed(_id, seed)
         if flag_update:
-            xml_filename = _id + '.xml'
-            ftp.download_xml(gateway_ip, self.gateways_xml_dir, xml_filename)
-            _gateway = gateway.Gateway(_id, (ip, port))
-            gateway_location, nodes = self.parser.get_xml_info(self.gateways_xml_dir + xml_filename)
-            for node in nodes:
-                node.gateway_id = _id
-
-            if flag_create:     # ( Send_seed = 1 ) > ( local_seed = 0 )
-                self.gateways_info[_id].id = _id
-                self.dbConnector.insert_gateway(_gateway, gateway_location, nodes)
-                # self.dbConnector.update_gateway_location(_id, gateway_location)
-                ftp.upload_file(ip, os.path.dirname(os.path.abspath(__file__)) + '/', utils.NODETYPES_FILE)
-                ftp.upload_file(ip, os.path.dirname(os.path.abspath(__file__)) + '/', utils.LOCATIONS_FILE)
-                self.upload_erase_images(ip)
-            else:
-                self.dbConnector.update_gateway_nodes(_gateway, nodes)
+            self.registration.register(_id, gateway_ip, ip, port, flag_create)
+
+        self.gateways_info[_id].timer = time.monotonic()
 
-        self.gateways_info[_id].timer = time.time()
+    def push_gateway_deadline(self, gateway_info, deadline):
+        heapq.heappush(self.gateways_deadlines, (deadline, next(self._deadline_seq), gateway_info))
 
     def check_seed(self, _id, seed):
         try:
@@ -193,13 +195,6 @@ class Server:
         self.gateways_info[_id].seed = seed
         return True
 
-    @staticmethod
-    def upload_erase_images(ip):
-        path = os.path.dirname(os.path.abspath(__file__)) + '/' + utils.ERASE_IMAGES_PATH + '/'
-        erase_images = [f for f in os.listdir(path) if os.path.isfile(os.path.join(path, f))]
-        for image in erase_images:
-            ftp.upload_erase_image(ip, path, image)
-
     def stop_thread(self):
         self._stop_thread_event.set()
 
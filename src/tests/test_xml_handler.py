@@ -0,0 +1,59 @@
+import io
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import xml_handler  # noqa: E402
+
+
+def make_descriptor(nodes_count):
+    """Gateway descriptor with `nodes_count` nodes spread over 2 buildings, 3 floors and 5 areas"""
+    xml = ['<?xml version="1.0" ?>\n<gateway id="gw1">\n'
+           '    <location><building>Building_A</building><floor>Floor_0</floor><area>Area_1</area></location>\n'
+           '    <nodes>\n']
+    for i in range(nodes_count):
+        xml.append('        <node id="%d"><nodetype_id>%s</nodetype_id><location><building>Building_%s</building>'
+                   '<floor>Floor_%d</floor><area>Area_%d</area></location></node>\n'
+                   % (i, 'UNO' if i % 2 else 'MTM-CM5000-SMA', 'AB'[i % 2], i % 3, i % 5))
+    xml.append('    </nodes>\n</gateway>\n')
+    return ''.join(xml).encode()
+
+
+class XmlParserTest(unittest.TestCase):
+
+    def setUp(self):
+        self.parser = xml_handler.XmlParser()
+        self.descriptor = make_descriptor(3000)
+        self.gateway_location, self.nodes = self.parser.get_xml_info(io.BytesIO(self.descriptor))
+
+    def test_gateway_location(self):
+        self.assertEqual(self.gateway_location, {'building': 'Building_A', 'floor': 'Floor_0', 'area': 'Area_1'})
+
+    def test_node_locations(self):
+        self.assertEqual(len(self.nodes), 3000)
+        for i, node in enumerate(self.nodes):
+            self.assertEqual(node.id, str(i))
+            self.assertEqual(dict(node.location), {'building': 'Building_' + 'AB'[i % 2],
+                                                   'floor': 'Floor_%d' % (i % 3), 'area': 'Area_%d' % (i % 5)})
+
+    def test_equal_locations_are_interned(self):
+        locations = {}
+        for node in self.nodes:
+            self.assertIs(locations.setdefault(node.location, node.location), node.location)
+        self.assertEqual(len(locations), 30)
+        self.assertEqual(len({id(node.location) for node in self.nodes}), 30)
+
+    def test_matches_tree_parsing(self):
+        root = self.parser.read_xml(io.BytesIO(self.descriptor))
+        self.assertEqual(self.parser.get_gateway_location(root), self.gateway_location)
+        tree_nodes = self.parser.get_nodes_info(root)
+        self.assertEqual([(node.id, node.nodetype_id) for node in tree_nodes],
+                         [(node.id, node.nodetype_id) for node in self.nodes])
+        for tree_node, node in zip(tree_nodes, self.nodes):
+            self.assertIs(tree_node.location, node.location)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,12 +5,17 @@ import glob
 import os
 import time
 import socket
+import hashlib
+import zlib
+
+import db.utils as db_utils
 
 
 NODETYPES_FILE = 'nodetypes.xml'
 LOCATIONS_FILE = 'locations.xml'
 
 ERASE_IMAGES_PATH = 'images/erase'
+UPLOADS_PATH = 'uploads'
 
 GATEWAY_ISALIVE = 'ISALIVE'
 GATEWAY_NODES_FLASH = 'GNF'.encode()
@@ -34,6 +39,9 @@ NODETYPES_GET = 'NTG'.encode()
 IMAGE_SAVE = 'IMS'.encode()
 IMAGES_GET = 'IMG'.encode()
 IMAGE_DELETE = 'IMD'.encode()
+IMAGE_UPLOAD_BEGIN = 'IUB'.encode()
+IMAGE_UPLOAD_CHUNK = 'IUC'.encode()
+IMAGE_UPLOAD_COMMIT = 'IUM'.encode()
 
 DEBUG_START = 'DST'.encode()
 DEBUG_END = 'DEN'.encode()
@@ -41,6 +49,16 @@ DEBUG_GATEWAY = 'DGA'.encode()
 DEBUG_CLEAR_LOG = 'DCL'.encode()
 DEBUG_GET_LOG = 'DGL'.encode()
 
+PROTOCOL_VERSION = 'PVR'.encode()
+
+# Frame formats, negotiated per connection with PROTOCOL_VERSION
+PROTOCOL_V1 = 1     # Request: action, 2-byte size, data. Response: 2-byte size, data
+PROTOCOL_V2 = 2     # Request: action, flags, 4-byte size, data. Response: flags, 4-byte size, data
+FLAG_COMPRESSED = 0x01  # Data is zlib compressed
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+COMPRESS_MIN_SIZE = 1024    # Smaller responses are sent as they are
+COMPRESS_LEVEL = 6
+
 FLASHED = 'FLASHED'
 ERASED = 'ERASED'
 ERROR = 'ERROR'
@@ -50,13 +68,18 @@ SIZE_ID = 8
 SIZE_IP = 16
 SIZE_ACTION = 3
 SIZE_OF_DATA = 2
+SIZE_FLAGS = 1
+SIZE_OF_DATA_V2 = 4
 SIZE_PORT = 2
 SIZE_SEED = 2
+SIZE_CHUNK_HEADER = 2
 
 SOCK_BUFSIZE = 1024
 
+_image_digests = {}     # {image path: (mtime_ns, size, sha256)}
 
-def segment_packet(pck, action=None):
+
+def segment_packet(pck, action=None, version=PROTOCOL_V1):
     """Segment a packet"""
 
     if action == GATEWAY_ISALIVE:
@@ -79,89 +102,264 @@ def segment_packet(pck, action=None):
                                SIZE_ACTION + SIZE_OF_DATA + pck_size[0]]))
     else:
         pck_action = struct.unpack('!' + str(SIZE_ACTION) + 's', bytes(pck[:SIZE_ACTION]))
-        pck_size = struct.unpack('!H', bytes(pck[SIZE_ACTION:SIZE_ACTION + SIZE_OF_DATA]))
-        return (pck_action[0],
-                json.loads(pck[SIZE_ACTION + SIZE_OF_DATA:
-                               SIZE_ACTION + SIZE_OF_DATA + pck_size[0]]))
+        if version == PROTOCOL_V2:
+            header_size = SIZE_ACTION + SIZE_FLAGS + SIZE_OF_DATA_V2
+            pck_flags, pck_size = struct.unpack('!BI', bytes(pck[SIZE_ACTION:header_size]))
+            data = memoryview(pck)[header_size:header_size + pck_size]
+            if pck_flags & FLAG_COMPRESSED:
+                data = memoryview(decompress(data))
+        else:
+            pck_size = struct.unpack('!H', bytes(pck[SIZE_ACTION:SIZE_ACTION + SIZE_OF_DATA]))
+            data = memoryview(pck)[SIZE_ACTION + SIZE_OF_DATA:SIZE_ACTION + SIZE_OF_DATA + pck_size[0]]
+
+        if pck_action[0] == IMAGE_UPLOAD_CHUNK:
+            return pck_action[0], segment_chunk(data)
+        return pck_action[0], json.loads(bytes(data))
+
 
+def decompress(data):
+    """Inflate the data of a compressed frame, refusing more than MAX_FRAME_SIZE bytes"""
+    decompressor = zlib.decompressobj()
+    data = decompressor.decompress(data, MAX_FRAME_SIZE)
+    if decompressor.unconsumed_tail:
+        raise ValueError('Decompressed frame larger than %d bytes' % MAX_FRAME_SIZE)
+    return data
 
-def create_request_packet(action, data):
+
+def segment_chunk(data):
+    """Split the data of an upload chunk: header size, JSON header { upload_id, offset, crc32 }, raw bytes"""
+    header_size = struct.unpack('!H', bytes(data[:SIZE_CHUNK_HEADER]))[0]
+    header = json.loads(bytes(data[SIZE_CHUNK_HEADER:SIZE_CHUNK_HEADER + header_size]))
+    header[db_utils.CHUNK_DATA] = data[SIZE_CHUNK_HEADER + header_size:]
+    return header
+
+
+def create_chunk_data(upload_id, offset, chunk):
+    """Data of an IMAGE_UPLOAD_CHUNK request"""
+    header = json.dumps({db_utils.UPLOAD_ID: upload_id, db_utils.UPLOAD_OFFSET: offset,
+                         db_utils.CHUNK_CRC32: zlib.crc32(chunk)}).encode()
+    return struct.pack('!H', len(header)) + header + chunk
+
+
+def create_request_packet(action, data, version=PROTOCOL_V1, flags=0):
     """Create a packet"""
     pck = bytearray()
 
     pck.extend(struct.pack('!' + str(SIZE_ACTION) + 's', action))
-    pck.extend(struct.pack('!H', len(data)))
+    if version == PROTOCOL_V2:
+        pck.extend(struct.pack('!BI', flags, len(data)))
+    else:
+        pck.extend(struct.pack('!H', len(data)))
     pck.extend(data)
 
     return pck
 
 
-def create_response_packet(data):
-    """Create a packet"""
-    pck = bytearray()
+class Response:
+    """Response data, framed for the protocol version of the connection it is sent on
+
+    The frame of each version is built once, so a response sent to many connections (e.g. a cached
+    one) is not copied or compressed again.
+    """
+
+    __slots__ = ('data', '_packets')
+
+    def __init__(self, data):
+        self.data = bytes(data)
+        self._packets = {}  # {(version, compress): packet}
+
+    def to_bytes(self, version=PROTOCOL_V1, compress=False):
+        """Packet for the protocol version, struct.error if the data does not fit in its frame
+
+        With `compress` the data is zlib compressed when the frame has a flags field (PROTOCOL_V2), it
+        is at least COMPRESS_MIN_SIZE bytes and compressing makes it smaller.
+        """
+        compress = compress and version == PROTOCOL_V2 and len(self.data) >= COMPRESS_MIN_SIZE
+        pck = self._packets.get((version, compress))
+        if pck is None:
+            if compress:
+                data = zlib.compress(self.data, COMPRESS_LEVEL)
+                if len(data) < len(self.data):
+                    pck = struct.pack('!BI', FLAG_COMPRESSED, len(data)) + data
+                else:
+                    pck = self.to_bytes(version)
+            elif version == PROTOCOL_V2:
+                pck = struct.pack('!BI', 0, len(self.data)) + self.data
+            else:
+                pck = struct.pack('!H', len(self.data)) + self.data
+            self._packets[(version, compress)] = pck
+        return pck
 
-    pck.extend(struct.pack('!H', len(data)))
-    pck.extend(data)
 
-    return pck
+def create_response_packet(data):
+    """Create a packet"""
+    return Response(data)
 
 
-def data_size_to_bytes(size):
+def data_size_to_bytes(size, version=PROTOCOL_V1):
+    """Response header for `size` bytes of data, struct.error if they do not fit in the frame"""
     pck = bytearray()
 
-    pck.extend(struct.pack('!H', size))
+    if version == PROTOCOL_V2:
+        pck.extend(struct.pack('!BI', 0, size))
+    else:
+        pck.extend(struct.pack('!H', size))
 
     return pck
 
 
-def read_data_from_socket(s):
-    buffer = b''
+class FileSegment:
+    """Part of an open file queued on a socket, sent with os.sendfile"""
+
+    __slots__ = ('file', 'offset', 'count')
 
-    while True:
+    def __init__(self, file, offset, count):
+        self.file = file
+        self.offset = offset
+        self.count = count
+
+    def send(self, s):
+        """Send as much of the segment as the socket takes, return the number of bytes sent"""
+        if hasattr(os, 'sendfile'):
+            sent = os.sendfile(s.fileno(), self.file.fileno(), self.offset, self.count)
+        else:
+            self.file.seek(self.offset)
+            sent = s.send(self.file.read(min(self.count, 64 * SOCK_BUFSIZE)))
+        if sent == 0 and self.count:
+            raise EOFError('File shorter than announced')
+        self.offset += sent
+        self.count -= sent
+        return sent
+
+    def close(self):
+        self.file.close()
+
+
+class FrameReader:
+    """Reassemble the request frames received on a connection
+
+    Data is received with recv_into in a buffer kept between reads, so a partial frame is completed
+    by the next reads without copying what was already received. The buffer grows to the size of
+    the frame being received when needed, and back to `size` once the frames are read. Frames are
+    read in the format of `version`, which may change between two frames.
+    """
+
+    def __init__(self, size=4 * SOCK_BUFSIZE):
+        self.version = PROTOCOL_V1
+        self._size = size
+        self._buffer = bytearray(size)
+        self._start = 0     # First byte not returned yet
+        self._end = 0       # End of the received data
+
+    def read(self, s):
+        """Receive the available data and return an iterator on the completed frames
+
+        None is returned if the connection is closed or sent a frame larger than MAX_FRAME_SIZE.
+        """
         try:
-            data = s.recv(SOCK_BUFSIZE)
-            if data:
-                buffer = buffer + data
-                if len(buffer) >= SIZE_ACTION + SIZE_OF_DATA:
-                    data_size = struct.unpack('!H', bytes(buffer[SIZE_ACTION:SIZE_ACTION + SIZE_OF_DATA]))[0]
-                    while data_size + SIZE_ACTION + SIZE_OF_DATA > len(buffer):
-                        data = s.recv(SOCK_BUFSIZE)
-                        if data:
-                            buffer = buffer + data
-                        else:
-                            break
-                    return buffer
-            else:
-                break
-        except socket.timeout as e:
-            print('Socket timeout', e)
-            break
-        except BlockingIOError as e:
-            print(e)
-            break
-        except ConnectionResetError as e:
+            self._reserve()
+            received = s.recv_into(memoryview(self._buffer)[self._end:])
+        except BlockingIOError:
+            return ()
+        except (ConnectionResetError, socket.timeout, ValueError) as e:
             print(e)
-            break
-
-    return buffer
+            return None
+        if not received:
+            return None
+        self._end += received
+        return self._frames()
+
+    def _frames(self):
+        while True:
+            frame_size = self._frame_size()
+            if frame_size is None or self._end - self._start < frame_size:
+                break
+            with memoryview(self._buffer) as view:    # Single copy of the frame
+                frame = bytes(view[self._start:self._start + frame_size])
+            self._start += frame_size
+            yield frame     # Handling the frame may change the version of the next ones
+        if self._start == self._end:
+            self._start = self._end = 0
+            if len(self._buffer) > self._size:  # Do not keep the room of a large frame
+                self._buffer = bytearray(self._size)
+
+    def _frame_size(self):
+        if self.version == PROTOCOL_V2:
+            header_size = SIZE_ACTION + SIZE_FLAGS + SIZE_OF_DATA_V2
+            if self._end - self._start < header_size:
+                return None
+            frame_size = header_size + struct.unpack_from('!I', self._buffer, self._start + SIZE_ACTION + SIZE_FLAGS)[0]
+        else:
+            if self._end - self._start < SIZE_ACTION + SIZE_OF_DATA:
+                return None
+            frame_size = SIZE_ACTION + SIZE_OF_DATA + \
+                struct.unpack_from('!H', self._buffer, self._start + SIZE_ACTION)[0]
+        if frame_size > MAX_FRAME_SIZE:
+            raise ValueError('Frame of %d bytes larger than %d bytes' % (frame_size, MAX_FRAME_SIZE))
+        return frame_size
+
+    def _reserve(self):
+        """Make room after the received data for the rest of the current frame, or SOCK_BUFSIZE bytes"""
+        pending = self._end - self._start
+        room = max((self._frame_size() or 0) - pending, SOCK_BUFSIZE)
+        if len(self._buffer) - self._end >= room:
+            return
+        if len(self._buffer) >= pending + room:   # Move the partial frame to the front
+            self._buffer[:pending] = self._buffer[self._start:self._end]
+        else:
+            buffer = bytearray(max(pending + room, 2 * len(self._buffer)))
+            buffer[:pending] = self._buffer[self._start:self._end]
+            self._buffer = buffer
+        self._start, self._end = 0, pending
 
 
-def send_invalid_token_error(s):
-    pck = create_response_packet(
+def create_invalid_token_packet():
+    # { message, status: 401 }
+    return create_response_packet(
         json.dumps({'message': 'INVALID TOKEN', 'status': 401}).encode()
     )
 
-    # { message, status: 401 }
-    s.sendall(pck)
-
 
-def send_invalid_slot_error(s):
-    pck = create_response_packet(
+def create_invalid_slot_packet():
+    # { message, status: 403 }
+    return create_response_packet(
         json.dumps({'message': 'INVALID SLOT', 'status': 403}).encode()
     )
 
-    # { message, status: 403 }
-    s.sendall(pck)
+
+def create_response_too_large_packet():
+    # { message, status: 413 }
+    return create_response_packet(
+        json.dumps({'message': 'RESPONSE TOO LARGE', 'status': 413}).encode()
+    )
+
+
+def create_request_too_large_packet():
+    # { message, status: 413 }
+    return create_response_packet(
+        json.dumps({'message': 'REQUEST TOO LARGE', 'status': 413}).encode()
+    )
+
+
+def create_invalid_name_packet():
+    # { message, status: 400 }
+    return create_response_packet(
+        json.dumps({'message': 'INVALID NAME', 'status': 400}).encode()
+    )
+
+
+def create_log_not_found_packet():
+    # { message, status: 404 }
+    return create_response_packet(
+        json.dumps({'message': 'LOG NOT FOUND', 'status': 404}).encode()
+    )
+
+
+def create_not_modified_packet(version):
+    # { version, status: 304 }
+    return create_response_packet(
+        json.dumps({'version': version, 'status': 304}).encode()
+    )
 
 
 def decode_auth_token(token):
@@ -214,11 +412,105 @@ def save_image(user_id, nodetype, name, data):
     f.flush()
 
 
+def is_valid_file_name(name):
+    """Whether a client given name (nodetype, image) is a single path component, so it stays in its directory"""
+    return isinstance(name, str) and name not in ('', '.', '..') and '\0' not in name and \
+        os.path.basename(name) == name
+
+
+def check_path_under(path, root):
+    """Raise ValueError if path does not resolve to a file under the root directory"""
+    root = os.path.realpath(root)
+    if os.path.commonpath([root, os.path.realpath(path)]) != root:
+        raise ValueError('Path %s outside of %s' % (path, root))
+
+
+def get_upload_path(user_id, nodetype, name):
+    """Temporary file an image is uploaded to, it is moved among the images on commit"""
+    root = os.path.dirname(os.path.abspath(__file__)) + '/' + UPLOADS_PATH + '/'
+    path = root + user_id + '/' + nodetype + '/' + name + '.part'
+    check_path_under(path, root)
+    return path
+
+
+def begin_image_upload(user_id, nodetype, name, restart=False):
+    """Start or resume the upload of an image, return the number of bytes already received"""
+    path = get_upload_path(user_id, nodetype, name)
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    if restart or not os.path.exists(path):
+        open(path, 'wb').close()
+    return os.path.getsize(path)
+
+
+def write_image_chunk(path, offset, data, crc32):
+    """Append a chunk to an upload
+
+    The chunk must start where the received data ends and match its CRC-32, otherwise it is ignored.
+    Return { offset, status }, offset being the size received so far.
+    """
+    try:
+        size = os.path.getsize(path)
+    except OSError:     # Committed or restarted by another upload of the same image
+        return {'message': 'UNKNOWN UPLOAD', 'status': 404}
+    if offset != size:
+        return {'message': 'INVALID OFFSET', db_utils.UPLOAD_OFFSET: size, 'status': 409}
+    if zlib.crc32(data) != crc32:
+        return {'message': 'INVALID CHECKSUM', db_utils.UPLOAD_OFFSET: size, 'status': 400}
+
+    with open(path, 'ab') as f:
+        f.write(data)
+    return {db_utils.UPLOAD_OFFSET: size + len(data), 'status': 200}
+
+
+def commit_image_upload(user_id, nodetype, name, size=None):
+    """Move a complete upload among the images of the user, replacing any image with that name"""
+    path = get_upload_path(user_id, nodetype, name)
+    if not os.path.exists(path):
+        return {'message': 'UNKNOWN UPLOAD', 'status': 404}
+    received = os.path.getsize(path)
+    if size is not None and received != size:
+        return {'message': 'INCOMPLETE UPLOAD', db_utils.UPLOAD_OFFSET: received, 'status': 400}
+
+    image_dir = os.path.dirname(os.path.abspath(__file__)) + '/images/' + user_id + '/' + nodetype + '/'
+    check_path_under(image_dir + name, os.path.dirname(os.path.abspath(__file__)) + '/images/')
+    if not os.path.exists(image_dir):
+        os.makedirs(image_dir)
+    os.replace(path, image_dir + name)
+    _image_digests.pop(image_dir + name, None)
+    check_and_delete_empty_folder(os.path.dirname(path))
+    check_and_delete_empty_folder(os.path.dirname(os.path.dirname(path)))
+    return {'status': 200}
+
+
+def file_digest(path):
+    """SHA-256 of a file"""
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def image_digest(path):
+    """SHA-256 of an image, cached until the file changes"""
+    stat = os.stat(path)
+    cached = _image_digests.get(path)
+    if cached and cached[:2] == (stat.st_mtime_ns, stat.st_size):
+        return cached[2]
+
+    digest = file_digest(path)
+    _image_digests[path] = (stat.st_mtime_ns, stat.st_size, digest)
+
+    return digest
+
+
 def delete_image(user_id, name, nodetype):
     image_path = os.path.dirname(os.path.abspath(__file__)) + '/images/' + user_id + '/' + nodetype + '/' + name
 
     if os.path.exists(image_path):
         os.remove(image_path)
+        _image_digests.pop(image_path, None)
         check_and_delete_empty_folder(os.path.dirname(os.path.abspath(__file__)) +
                                       '/images/' + user_id + '/' + nodetype)
         check_and_delete_empty_folder(os.path.dirname(os.path.abspath(__file__)) + '/images/' + user_id)
@@ -1,17 +1,24 @@
 import threading
 import socket
-import select
+import selectors
+import collections
 import sys
 import os
 import ftplib
 import logging.config
 import json
+import itertools
+import functools
+import secrets
+import struct
+import zlib
 
 import ftp
 import utils
+import dispatcher
 import db.utils as db_utils
-import timeoutwatch
-import perpetual_timer
+import scheduler
+import log_writer
 
 
 class WebHandler(threading.Thread):
@@ -19,545 +26,732 @@ class WebHandler(threading.Thread):
         threading.Thread.__init__(self)
         self.dbConnector = db_connector
         self.server_cfg = server_cfg
-        self.slotsStartWatch = timeoutwatch.TimeoutWatch(float(self.server_cfg['timeout_slots_start']))
-        self.slotsEndWatch = timeoutwatch.TimeoutWatch(float(self.server_cfg['timeout_slots_end']))
         self.experiment_dir = self.server_cfg['experiment_dir']
         self._stop_thread_event = stop_thread_event
 
         self.sock_tcp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.sock_tcp.setblocking(False)
         self.sock_tcp.bind((self.server_cfg['public_ip'], int(self.server_cfg['public_port'])))
-        self.sock_tcp.listen(5)
-        self.inputs = [self.sock_tcp]
-
-        self.gateway_sockets = []  # List of lists with pending requests (flash, erase, reset)
-        self.gateway_sockets_info = []  # [{web_socket, data, image_name}]
+        self.sock_tcp.listen(socket.SOMAXCONN)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.sock_tcp, selectors.EVENT_READ)
+        self.outputs = {}   # {socket: deque of pending writes}
+        self.readers = {}   # {socket: FrameReader}
+        self.closing = set()    # Sockets to close once their pending writes are flushed
+
+        self.dispatcher = dispatcher.GatewayDispatcher(int(self.server_cfg['max_dispatch_workers']),
+                                                       float(self.server_cfg['timeout_gateway_request']))
+        self.selector.register(self.dispatcher.wakeup, selectors.EVENT_READ)
+        self.timeout_gateway_reply = float(self.server_cfg['timeout_gateway_reply'])
+        self.gateway_requests = {}  # Pending requests (flash, erase, reset) {request_id: {web_socket, data, ...}}
+        self.gateway_sockets = {}   # {gateway socket: GatewayJob}
+        self._request_ids = itertools.count()
         self.experiment_info = {}
+        self.ended_slot_id = None   # Slot whose debug log was closed by DEBUG_END, until DEBUG_START
+        self.responses = {}     # Serialized responses of the polled GET actions {name: (version, packet)}
+        self.uploads = {}       # Image uploads in progress {upload_id: {socket, user, nodetype_id, image_name, path}}
         self.sock_debug = None
         self._debug_lock = threading.Lock()
-
-        self.log_timer = perpetual_timer.PerpetualTimer(float(self.server_cfg['timeout_log_file']),
-                                                        utils.delete_old_logs,
-                                                        (float(self.server_cfg['timer_log_file']), self.experiment_dir))
-        self.log_timer.start()
+        self.log_writer = log_writer.LogWriter(int(self.server_cfg['debug_log_buffer_size']),
+                                               float(self.server_cfg['timeout_debug_log_flush']))
+        self.log_writer.start()
 
         logging.config.fileConfig(os.path.dirname(os.path.abspath(__file__)) + '/' + 'logging.conf')
         self.logger = logging.getLogger('web')
 
-    def run(self):
-        self.slotsStartWatch.start()
-        self.slotsEndWatch.start()
+        self.scheduler = scheduler.Scheduler(self.logger)
+        self.scheduler.call_every(float(self.server_cfg['timeout_slots_start']), self.check_slots_start)
+        self.scheduler.call_every(float(self.server_cfg['timeout_slots_end']), self.check_slots_end)
+        self.scheduler.call_every(float(self.server_cfg['timeout_log_file']), utils.delete_old_logs,
+                                  float(self.server_cfg['timer_log_file']), self.experiment_dir)
 
+    def run(self):
         while not self.stopped_thread():
-            self.check_timeouts()
-            new_timeout = self.get_next_timeout()
-            readable, writable, exceptional = select.select(self.inputs, [], self.inputs, new_timeout)
+            self.scheduler.run_pending()
+            events = self.selector.select(self.scheduler.next_timeout())
 
-            for s in readable:
+            for key, mask in events:
+                s = key.fileobj
                 if s is self.sock_tcp:
                     (connection, address) = self.sock_tcp.accept()
-                    connection.setblocking(False)
                     self.logger.info('TCP CON (%s, %d)' % (address[0], address[1]))
-                    self.inputs.append(connection)
-                else:
-                    buffer = utils.read_data_from_socket(s)
-                    if buffer:
-                        self.logger.debug('Req_data = %s\t client = (%s, %d)'
-                                          % (buffer, s.getpeername()[0], s.getpeername()[1]))
-                        action, data = utils.segment_packet(buffer)
-
-                        if action == utils.GATEWAY_NODES_FLASH:
-                            image_name = self.get_image_name(s)
-                            result = []
-                            for node in data[db_utils.NODES]:
-                                if node['status'] == utils.FLASHED:
-                                    gateway_id = self.dbConnector.find_gateway_by_addr(s.getpeername())
-                                    node_uid = self.dbConnector.get_node_uid_by_gateway_id_and_node_id(
-                                        gateway_id, node['node_id'])
-                                    self.dbConnector.node_update_flash_info(node_uid, 'FINISHED', image_name)
-                                    _node = {'_id': node_uid, 'status': node['status']}
-                                else:   # node['status'] = utils.ERROR
-                                    gateway_id = self.dbConnector.find_gateway_by_addr(s.getpeername())
-                                    node_uid = self.dbConnector.get_node_uid_by_gateway_id_and_node_id(
-                                        gateway_id, node['node_id'])
-                                    _node = {'_id': node_uid, 'status': node['status']}
-                                result.append(_node)
-
-                            self.handle_gateway_request(s, result)
-                            self.inputs.remove(s)
-                            s.close()
-
-                        elif action == utils.GATEWAY_NODES_ERASE:
-                            result = []
-                            for node in data[db_utils.NODES]:
-                                if node['status'] == utils.ERASED:
-                                    gateway_id = self.dbConnector.find_gateway_by_addr(s.getpeername())
-                                    node_uid = self.dbConnector.get_node_uid_by_gateway_id_and_node_id(
-                                        gateway_id, node['node_id'])
-                                    self.dbConnector.node_update_flash_info(node_uid, 'NOT_STARTED', None)
-                                    _node = {'_id': node_uid, 'status': node['status']}
-                                else:   # node['status'] = utils.ERROR
-                                    gateway_id = self.dbConnector.find_gateway_by_addr(s.getpeername())
-                                    node_uid = self.dbConnector.get_node_uid_by_gateway_id_and_node_id(
-                                        gateway_id, node['node_id'])
-                                    _node = {'_id': node_uid, 'status': node['status']}
-                                result.append(_node)
-
-                            self.handle_gateway_request(s, result)
-                            self.inputs.remove(s)
-                            s.close()
-
-                        elif action == utils.GATEWAY_NODES_RESET:
-                            result = []
-                            for node in data[db_utils.NODES]:
-                                gateway_id = self.dbConnector.find_gateway_by_addr(s.getpeername())
-                                node_uid = self.dbConnector.get_node_uid_by_gateway_id_and_node_id(
-                                    gateway_id, node['node_id'])
-                                _node = {'_id': node_uid, 'status': node['status']}
-                                result.append(_node)
-
-                            self.handle_gateway_request(s, result)
-                            self.inputs.remove(s)
-                            s.close()
-
-                        elif action == utils.IMAGES_GET:  # { token }
-                            token = data[db_utils.TOKEN]
-                            decoded_token = utils.decode_auth_token(token)
-                            if not decoded_token:
-                                utils.send_invalid_token_error(s)
-                            else:
-                                nodetypes_images = utils.get_nodetypes_images(decoded_token[db_utils.USER])
-                                pck = utils.create_response_packet(json.dumps({'data': nodetypes_images, 'status': 200})
-                                                                   .encode())
-
-                                # OnSuccess: { data, status: 200 }
-                                s.sendall(pck)
-
-                        elif action == utils.IMAGE_SAVE:  # { token, image_name, image_data, nodetype_id }
-                            token = data[db_utils.TOKEN]
-                            decoded_token = utils.decode_auth_token(token)
-                            if not decoded_token:
-                                utils.send_invalid_token_error(s)
-                            else:
-                                utils.save_image(decoded_token[db_utils.USER], data[db_utils.NODETYPE_ID],
-                                                 data[db_utils.IMAGE_NAME], data[db_utils.IMAGE_DATA])
-                                pck = utils.create_response_packet(json.dumps({'status': 200}).encode())
-
-                                # OnSuccess: { status: 200 }
-                                s.sendall(pck)
-
-                        elif action == utils.IMAGE_DELETE:  # { token, image_name }
-                            token = data[db_utils.TOKEN]
-                            decoded_token = utils.decode_auth_token(token)
-                            if not decoded_token:
-                                utils.send_invalid_token_error(s)
-                            else:
-                                nodetype_id = utils.get_nodetype_by_user_and_image_name(decoded_token[db_utils.USER],
-                                                                                        data[db_utils.IMAGE_NAME])
-                                res = utils.delete_image(decoded_token[db_utils.USER],
-                                                         data[db_utils.IMAGE_NAME],
-                                                         nodetype_id)
-                                pck = utils.create_response_packet(json.dumps(res).encode())
-
-                                # OnSuccess: { status: 204 }
-                                # OnError  : { status: 404 }
-                                s.sendall(pck)
-
-                        elif action == utils.NODES_GET:  # { token }
-                            token = data[db_utils.TOKEN]
-                            decoded_token = utils.decode_auth_token(token)
-                            if not decoded_token:
-                                utils.send_invalid_token_error(s)
-                            else:
-                                nodes = self.dbConnector.get_nodes()
-                                pck = utils.create_response_packet(json.dumps({'nodes': nodes, 'status': 200}).encode())
-
-                                # OnSuccess: { nodes, status: 200 }
-                                s.sendall(pck)
-
-                        elif action == utils.NODES_FLASH:  # { token, slot_id, image_name, node_uids}
-                            token = data[db_utils.TOKEN]
-                            slot_id = data[db_utils.TIMESLOT_ID]
-                            decoded_token = utils.decode_auth_token(token)
-                            if not decoded_token:
-                                utils.send_invalid_token_error(s)
-                            elif not self.dbConnector.get_slot_by_id(slot_id):
-                                utils.send_invalid_slot_error(s)
-                            else:
-                                gateway_socks = self.send_flash_request(decoded_token[db_utils.USER],
-                                                                        data[db_utils.IMAGE_NAME],
-                                                                        data[db_utils.NODE_UIDS])
-                                self.inputs.extend(gateway_socks)
-                                self.gateway_sockets.append(gateway_socks)
-                                self.gateway_sockets_info.append({'web_socket': s, 'data': [],
-                                                                  db_utils.IMAGE_NAME: data[db_utils.IMAGE_NAME]})
-
-                        elif action == utils.NODES_ERASE:  # { token, slot_id, node_uids }
-                            token = data[db_utils.TOKEN]
-                            slot_id = data[db_utils.TIMESLOT_ID]
-                            decoded_token = utils.decode_auth_token(token)
-                            if not decoded_token:
-                                utils.send_invalid_token_error(s)
-                            elif not self.dbConnector.get_slot_by_id(slot_id):
-                                utils.send_invalid_slot_error(s)
-                            else:
-                                gateway_socks = self.send_erase_request(data[db_utils.NODE_UIDS])
-                                self.inputs.extend(gateway_socks)
-                                self.gateway_sockets.append(gateway_socks)
-                                self.gateway_sockets_info.append({'web_socket': s, 'data': [], db_utils.IMAGE_NAME: ''})
-
-                        elif action == utils.NODES_RESET:  # { token, slot_id, node_uids }
-                            token = data[db_utils.TOKEN]
-                            slot_id = data[db_utils.TIMESLOT_ID]
-                            decoded_token = utils.decode_auth_token(token)
-                            if not decoded_token:
-                                utils.send_invalid_token_error(s)
-                            elif not self.dbConnector.get_slot_by_id(slot_id):
-                                utils.send_invalid_slot_error(s)
-                            else:
-                                gateway_socks = self.send_reset_request(data[db_utils.NODE_UIDS])
-                                self.inputs.extend(gateway_socks)
-                                self.gateway_sockets.append(gateway_socks)
-                                self.gateway_sockets_info.append({'web_socket': s, 'data': [], db_utils.IMAGE_NAME: ''})
-
-                        elif action == utils.TIMESLOTS_SAVE:  # { token, slots: [{start, end}] }
-                            token = data[db_utils.TOKEN]
-                            decoded_token = utils.decode_auth_token(token)
-                            if not decoded_token:
-                                utils.send_invalid_token_error(s)
-                            else:
-                                slots = db_utils.convert_isoformat_to_datetime(data[db_utils.SLOTS])
-                                slots_saved = self.dbConnector.save_timeslots(decoded_token[db_utils.USER], slots)
-                                slots = db_utils.convert_datetime_to_isoformat(slots_saved)
-                                pck = utils.create_response_packet(json.dumps({'slots': slots, 'status': 200}).encode())
-
-                                # OnSuccess: { slots: [{start, end}], status: 200 }
-                                s.sendall(pck)
-
-                        elif action == utils.TIMESLOTS_GET_DAYSLOTS:  # { token, date }
-                            token = data[db_utils.TOKEN]
-                            decoded_token = utils.decode_auth_token(token)
-                            if not decoded_token:
-                                utils.send_invalid_token_error(s)
-                            else:
-                                slots_day = self.dbConnector.get_day_slots(data[db_utils.DATE])
-                                slots = db_utils.convert_datetime_to_isoformat(slots_day)
-                                pck = utils.create_response_packet(json.dumps({'slots': slots, 'status': 200}).encode())
-
-                                # OnSuccess: { slots: [{start, end, user_id}], status: 200 }
-                                s.sendall(pck)
-
-                        elif action == utils.TIMESLOTS_GET_USERSLOTS:  # { token }
-                            token = data[db_utils.TOKEN]
-                            decoded_token = utils.decode_auth_token(token)
-                            if not decoded_token:
-                                utils.send_invalid_token_error(s)
-                            else:
-                                user_slots = self.dbConnector.get_user_slots(decoded_token[db_utils.USER])
-                                slots = db_utils.convert_datetime_to_isoformat(user_slots)
-                                pck = utils.create_response_packet(json.dumps({'slots': slots, 'status': 200}).encode())
-
-                                # OnSuccess: { slots: [{slot_id, start, end}], status: 200 }
-                                s.sendall(pck)
-
-                        elif action == utils.NODETYPES_GET:  # { token }
-                            token = data[db_utils.TOKEN]
-                            decoded_token = utils.decode_auth_token(token)
-                            if not decoded_token:
-                                utils.send_invalid_token_error(s)
-                            else:
-                                nodetypes = self.dbConnector.get_nodetypes()
-                                pck = utils.create_response_packet(
-                                    json.dumps({'nodetypes': nodetypes, 'status': 200}).encode()
-                                )
-
-                                # OnSuccess: { nodetypes, status: 201 }
-                                s.sendall(pck)
-
-                        elif action == utils.USERS_SIGNUP:  # { email, username, password }
-                            res = self.dbConnector.create_user(data)
-                            pck = utils.create_response_packet(json.dumps(res).encode())
-
-                            # OnSuccess: { status: 201 }
-                            # OnError  : { message, status: 403 }
-                            s.sendall(pck)
-
-                        elif action == utils.USERS_LOGIN:  # { email, username }
-                            res = self.dbConnector.login_user(data)
-                            pck = utils.create_response_packet(json.dumps(res).encode())
-
-                            # OnSuccess: { token, status: 200}
-                            # OnError  : { message, status: 401 }
-                            s.sendall(pck)
-
-                        elif action == utils.DEBUG_START:  # { token, slot_id }
-                            token = data[db_utils.TOKEN]
-                            slot_id = data[db_utils.TIMESLOT_ID]
-                            decoded_token = utils.decode_auth_token(token)
-                            if not decoded_token:
-                                utils.send_invalid_token_error(s)
-                            elif not self.dbConnector.get_slot_by_id(slot_id):
-                                utils.send_invalid_slot_error(s)
-                            else:
-                                if self.sock_debug:
-                                    utils.remove_from_list(self.inputs, self.sock_debug)
-                                    self.sock_debug.close()
-                                log_data = ['=== DEBUG CHANNEL START ===\n===========================\n']
-                                pck = utils.create_response_packet(json.dumps({'data': log_data}).encode())
-                                self.sock_debug = s
-                                self.sock_debug.sendall(pck)
-
-                        elif action == utils.DEBUG_END:  # { token, slot_id }
-                            token = data[db_utils.TOKEN]
-                            slot_id = data[db_utils.TIMESLOT_ID]
-                            decoded_token = utils.decode_auth_token(token)
-                            if not decoded_token:
-                                utils.send_invalid_token_error(s)
-                            elif not self.dbConnector.get_slot_by_id(slot_id):
-                                utils.send_invalid_slot_error(s)
-                            else:
-                                log_data = ['=== DEBUG CHANNEL END ===\n=========================\n']
-                                if self.sock_debug:
-                                    self.experiment_info = {}
-                                    pck = utils.create_response_packet(json.dumps({'data': log_data,
-                                                                                   'message': 'STOP DEBUG'}).encode())
-                                    self.sock_debug.sendall(pck)
-
-                                    utils.remove_from_list(self.inputs, self.sock_debug)
-                                    self.sock_debug.close()
-                                    self.sock_debug = None
-
-                                    # { status: 204 }
-                                    pck = utils.create_response_packet(json.dumps({'status': 204}).encode())
-                                    s.sendall(pck)
-
-                        elif action == utils.DEBUG_CLEAR_LOG:  # { token, slot_id }
-                            token = data[db_utils.TOKEN]
-                            slot_id = data[db_utils.TIMESLOT_ID]
-                            decoded_token = utils.decode_auth_token(token)
-                            if not decoded_token:
-                                utils.send_invalid_token_error(s)
-                            elif not self.dbConnector.get_slot_by_id(slot_id):
-                                utils.send_invalid_slot_error(s)
-                            else:
-                                self.clear_debug_log(decoded_token[db_utils.USER], slot_id)
-                                pck = utils.create_response_packet(json.dumps({'status': 204}).encode())
-
-                                # OnSuccess: { status: 204 }
-                                s.sendall(pck)
-
-                        elif action == utils.DEBUG_GET_LOG:  # { token, slot_id }
-                            token = data[db_utils.TOKEN]
-                            slot_id = data[db_utils.TIMESLOT_ID]
-                            decoded_token = utils.decode_auth_token(token)
-                            if not decoded_token:
-                                utils.send_invalid_token_error(s)
-                            elif not self.dbConnector.get_slot_by_id(slot_id):
-                                utils.send_invalid_slot_error(s)
-                            else:
-                                self.send_debug_log(s, decoded_token[db_utils.USER], slot_id)
-
-                        elif action == utils.DEBUG_GATEWAY:  # [ TIMESTAMP, NODE_ID, DATA ]
-                            print(data[0], '|', data[1], '|', data[2])
-                            if self.experiment_info:
-                                self.write_debug_log(data)
-                            if self.sock_debug:
-                                pck = utils.create_response_packet(json.dumps({'data': data}).encode())
-                                self.sock_debug.sendall(pck)
-
-                    else:
-                        self.logger.info('TCP DISCON (%s, %d)' % (s.getpeername()[0], s.getpeername()[1]))
-                        self.inputs.remove(s)
-                        s.close()
-
-            for s in exceptional:
-                self.inputs.remove(s)
-                s.close()
-
-        for sock in self.inputs:
+                    self.add_socket(connection)
+                    continue
+                if s is self.dispatcher.wakeup:
+                    self.handle_dispatched_jobs()
+                    continue
+
+                if mask & selectors.EVENT_WRITE:
+                    self.flush(s)
+                # The socket may have been closed while handling a previous event
+                if mask & selectors.EVENT_READ and s in self.outputs:
+                    frames = self.readers[s].read(s)
+                    if frames is None:
+                        self.logger.info('TCP DISCON [%s]' % s)
+                        self.disconnect(s)
+                        continue
+                    try:
+                        for frame in frames:
+                            # Not the data, a frame can be a megabytes image chunk
+                            self.logger.debug('Req_action = %s\t size = %d\t client = %s',
+                                              frame[:utils.SIZE_ACTION], len(frame), s.getpeername())
+                            action, data = utils.segment_packet(frame, version=self.readers[s].version)
+                            self.handle_request(s, action, data)
+                            if s not in self.outputs:   # Closed by the request
+                                break
+                    except (ValueError, struct.error, zlib.error) as e:
+                        self.logger.error('Invalid frame [%s]: %s' % (s, e))
+                        self.disconnect(s)
+
+        for sock in list(self.outputs):
             self.logger.debug('Exiting. . . Closing [%s]' % sock)
             sock.close()
-        self.log_timer.cancel()
+        self.logger.debug('Scheduler %s' % self.scheduler.stats())
+        self.log_writer.stop()
+        self.log_writer.join()
+        self.dispatcher.close()
+        self.selector.close()
         self.sock_tcp.close()
         sys.exit('Exiting. . .')
 
-    def get_image_name(self, s):
-        for idx, sublist in enumerate(self.gateway_sockets):
-            if s in sublist:
-                return self.gateway_sockets_info[idx]['image_name']
-
-    def handle_gateway_request(self, s, data):
-        for idx, sublist in enumerate(self.gateway_sockets):
-            if s in sublist:
-                sublist.remove(s)
-                if not sublist:
-                    del self.gateway_sockets[idx]
-                    self.gateway_sockets_info[idx]['data'].extend(data)
-                    web_socket = self.gateway_sockets_info[idx]['web_socket']
-                    if web_socket:
-                        pck = utils.create_response_packet(json.dumps({'data': self.gateway_sockets_info[idx]['data']})
-                                                           .encode())
-                        web_socket.sendall(pck)
-                    del self.gateway_sockets_info[idx]
-                    break
-                else:
-                    self.gateway_sockets_info[idx]['data'].extend(data)
+    def handle_request(self, s, action, data):
+        if action == utils.GATEWAY_NODES_FLASH:
+            job = self.pop_gateway_job(s)
+            image_name = self.gateway_requests[job.request_id][db_utils.IMAGE_NAME]
+            result = self.handle_gateway_report(job, data[db_utils.NODES], utils.FLASHED,
+                                                db_utils.FLASH_FINISHED, image_name)
 
-    def send_flash_request(self, user_id, image_name, node_uids):
-        nodetype_id = utils.get_nodetype_by_user_and_image_name(user_id, image_name)
+            self.handle_gateway_request(job.request_id, result)
+            self.remove_socket(s)
 
-        gateway_info = self.get_gateway_info(node_uids)
+        elif action == utils.GATEWAY_NODES_ERASE:
+            job = self.pop_gateway_job(s)
+            result = self.handle_gateway_report(job, data[db_utils.NODES], utils.ERASED,
+                                                db_utils.FLASH_NOT_STARTED, None)
 
-        gateways_sockets = []
-        for gateway_id, node_uids in gateway_info.items():
-            gateway_addr = self.dbConnector.get_gateway_addr(gateway_id)
-            ftp.upload_image(gateway_addr[0], image_name, user_id, nodetype_id)
+            self.handle_gateway_request(job.request_id, result)
+            self.remove_socket(s)
 
-            sock_tcp_gateway = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock_tcp_gateway.connect((gateway_addr[0], gateway_addr[1]))
+        elif action == utils.GATEWAY_NODES_RESET:
+            job = self.pop_gateway_job(s)
+            result = self.handle_gateway_report(job, data[db_utils.NODES])
 
-            data = {db_utils.IMAGE_NAME: image_name, db_utils.NODE_IDS: []}
-            for node_uid in node_uids:
-                node_id = self.dbConnector.get_node_id_by_uid(node_uid)
-                data[db_utils.NODE_IDS].append(node_id)
-            pck = utils.create_request_packet(utils.NODES_FLASH, json.dumps(data).encode())
-            sock_tcp_gateway.sendall(pck)
+            self.handle_gateway_request(job.request_id, result)
+            self.remove_socket(s)
 
-            gateways_sockets.append(sock_tcp_gateway)
-
-        return gateways_sockets
-
-        # if self.prompt_flag:
-        #   self.prompt.update_node_state()
-
-    def send_erase_request(self, node_uids):
-        gateway_info = self.get_gateway_info(node_uids)
+        elif action == utils.PROTOCOL_VERSION:  # { version }
+            version = max(utils.PROTOCOL_V1, min(int(data['version']), utils.PROTOCOL_V2))
+            pck = utils.create_response_packet(json.dumps({'version': version, 'status': 200}).encode())
 
-        gateways_sockets = []
-        for gateway_id, node_uids in gateway_info.items():
-            gateway_addr = self.dbConnector.get_gateway_addr(gateway_id)
+            # OnSuccess: { version, status: 200 }, framed in the current version. Next frames use the new one
+            self.send(s, pck)
+            self.readers[s].version = version
 
-            sock_tcp_gateway = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock_tcp_gateway.connect((gateway_addr[0], gateway_addr[1]))
+        elif action == utils.IMAGES_GET:  # { token, [compress] }
+            token = data[db_utils.TOKEN]
+            decoded_token = utils.decode_auth_token(token)
+            if not decoded_token:
+                self.send(s, utils.create_invalid_token_packet())
+            else:
+                nodetypes_images = utils.get_nodetypes_images(decoded_token[db_utils.USER])
+                pck = utils.create_response_packet(json.dumps({'data': nodetypes_images, 'status': 200})
+                                                   .encode())
+
+                # OnSuccess: { data, status: 200 }
+                self.send(s, pck, data.get(db_utils.COMPRESS, False))
+
+        elif action == utils.IMAGE_SAVE:  # { token, image_name, image_data, nodetype_id }
+            token = data[db_utils.TOKEN]
+            decoded_token = utils.decode_auth_token(token)
+            if not decoded_token:
+                self.send(s, utils.create_invalid_token_packet())
+            else:
+                utils.save_image(decoded_token[db_utils.USER], data[db_utils.NODETYPE_ID],
+                                 data[db_utils.IMAGE_NAME], data[db_utils.IMAGE_DATA])
+                pck = utils.create_response_packet(json.dumps({'status': 200}).encode())
+
+                # OnSuccess: { status: 200 }
+                self.send(s, pck)
+
+        elif action == utils.IMAGE_UPLOAD_BEGIN:  # { token, image_name, nodetype_id, [restart] }
+            token = data[db_utils.TOKEN]
+            decoded_token = utils.decode_auth_token(token)
+            if not decoded_token:
+                self.send(s, utils.create_invalid_token_packet())
+            elif not all(utils.is_valid_file_name(name) for name in (decoded_token[db_utils.USER],
+                                                                     data[db_utils.NODETYPE_ID],
+                                                                     data[db_utils.IMAGE_NAME])):
+                self.send(s, utils.create_invalid_name_packet())
+            else:
+                user_id = decoded_token[db_utils.USER]
+                # An interrupted upload of the same image resumes where it stopped, unless restarted
+                offset = utils.begin_image_upload(user_id, data[db_utils.NODETYPE_ID], data[db_utils.IMAGE_NAME],
+                                                  data.get(db_utils.UPLOAD_RESTART, False))
+                upload_id = secrets.token_hex(16)
+                self.uploads[upload_id] = {'socket': s, db_utils.USER: user_id,
+                                           db_utils.NODETYPE_ID: data[db_utils.NODETYPE_ID],
+                                           db_utils.IMAGE_NAME: data[db_utils.IMAGE_NAME],
+                                           'path': utils.get_upload_path(user_id, data[db_utils.NODETYPE_ID],
+                                                                         data[db_utils.IMAGE_NAME])}
+                pck = utils.create_response_packet(json.dumps({db_utils.UPLOAD_ID: upload_id,
+                                                               db_utils.UPLOAD_OFFSET: offset,
+                                                               'status': 200}).encode())
+
+                # OnSuccess: { upload_id, offset, status: 200 }
+                self.send(s, pck)
+
+        elif action == utils.IMAGE_UPLOAD_CHUNK:  # { upload_id, offset, crc32 } + chunk
+            upload = self.uploads.get(data[db_utils.UPLOAD_ID])
+            if upload is None:
+                res = {'message': 'UNKNOWN UPLOAD', 'status': 404}
+            else:
+                res = utils.write_image_chunk(upload['path'], data[db_utils.UPLOAD_OFFSET], data[db_utils.CHUNK_DATA],
+                                              data[db_utils.CHUNK_CRC32])
 
-            data = {db_utils.NODE_IDS: []}
-            for node_uid in node_uids:
-                node_id = self.dbConnector.get_node_id_by_uid(node_uid)
-                data[db_utils.NODE_IDS].append(node_id)
-            pck = utils.create_request_packet(utils.NODES_ERASE, json.dumps(data).encode())
-            sock_tcp_gateway.sendall(pck)
+            # OnSuccess: { offset, status: 200 }
+            self.send(s, utils.create_response_packet(json.dumps(res).encode()))
 
-            gateways_sockets.append(sock_tcp_gateway)
+        elif action == utils.IMAGE_UPLOAD_COMMIT:  # { upload_id, [size] }
+            upload = self.uploads.pop(data[db_utils.UPLOAD_ID], None)
+            if upload is None:
+                res = {'message': 'UNKNOWN UPLOAD', 'status': 404}
+            else:
+                res = utils.commit_image_upload(upload[db_utils.USER], upload[db_utils.NODETYPE_ID],
+                                                upload[db_utils.IMAGE_NAME], data.get(db_utils.UPLOAD_SIZE))
+                if res['status'] != 200:    # Let the client send the rest and commit again
+                    self.uploads[data[db_utils.UPLOAD_ID]] = upload
+                else:   # Other uploads of the same image have lost their file
+                    for upload_id in [upload_id for upload_id, other in self.uploads.items()
+                                      if other['path'] == upload['path']]:
+                        del self.uploads[upload_id]
+
+            # OnSuccess: { status: 200 }
+            self.send(s, utils.create_response_packet(json.dumps(res).encode()))
+
+        elif action == utils.IMAGE_DELETE:  # { token, image_name }
+            token = data[db_utils.TOKEN]
+            decoded_token = utils.decode_auth_token(token)
+            if not decoded_token:
+                self.send(s, utils.create_invalid_token_packet())
+            else:
+                nodetype_id = utils.get_nodetype_by_user_and_image_name(decoded_token[db_utils.USER],
+                                                                        data[db_utils.IMAGE_NAME])
+                res = utils.delete_image(decoded_token[db_utils.USER],
+                                         data[db_utils.IMAGE_NAME],
+                                         nodetype_id)
+                pck = utils.create_response_packet(json.dumps(res).encode())
+
+                # OnSuccess: { status: 204 }
+                # OnError  : { status: 404 }
+                self.send(s, pck)
+
+        elif action == utils.NODES_GET:  # { token, [version], [compress] }
+            token = data[db_utils.TOKEN]
+            decoded_token = utils.decode_auth_token(token)
+            if not decoded_token:
+                self.send(s, utils.create_invalid_token_packet())
+            else:
+                # OnSuccess: { nodes, version, status: 200 } or { version, status: 304 }
+                self.send(s, self.get_cached_response('nodes', data.get('version'),
+                                                      self.dbConnector.get_nodes_version(),
+                                                      self.dbConnector.get_nodes),
+                          data.get(db_utils.COMPRESS, False))
+
+        elif action == utils.NODES_FLASH:  # { token, slot_id, image_name, node_uids}
+            token = data[db_utils.TOKEN]
+            slot_id = data[db_utils.TIMESLOT_ID]
+            decoded_token = utils.decode_auth_token(token)
+            if not decoded_token:
+                self.send(s, utils.create_invalid_token_packet())
+            elif not self.dbConnector.get_slot_by_id(slot_id):
+                self.send(s, utils.create_invalid_slot_packet())
+            else:
+                self.send_flash_request(s, decoded_token[db_utils.USER], data[db_utils.IMAGE_NAME],
+                                        data[db_utils.NODE_UIDS])
+
+        elif action == utils.NODES_ERASE:  # { token, slot_id, node_uids }
+            token = data[db_utils.TOKEN]
+            slot_id = data[db_utils.TIMESLOT_ID]
+            decoded_token = utils.decode_auth_token(token)
+            if not decoded_token:
+                self.send(s, utils.create_invalid_token_packet())
+            elif not self.dbConnector.get_slot_by_id(slot_id):
+                self.send(s, utils.create_invalid_slot_packet())
+            else:
+                self.send_erase_request(s, data[db_utils.NODE_UIDS])
+
+        elif action == utils.NODES_RESET:  # { token, slot_id, node_uids }
+            token = data[db_utils.TOKEN]
+            slot_id = data[db_utils.TIMESLOT_ID]
+            decoded_token = utils.decode_auth_token(token)
+            if not decoded_token:
+                self.send(s, utils.create_invalid_token_packet())
+            elif not self.dbConnector.get_slot_by_id(slot_id):
+                self.send(s, utils.create_invalid_slot_packet())
+            else:
+                self.send_reset_request(s, data[db_utils.NODE_UIDS])
 
-        return gateways_sockets
+        elif action == utils.TIMESLOTS_SAVE:  # { token, slots: [{start, end}] }
+            token = data[db_utils.TOKEN]
+            decoded_token = utils.decode_auth_token(token)
+            if not decoded_token:
+                self.send(s, utils.create_invalid_token_packet())
+            else:
+                slots = db_utils.convert_isoformat_to_datetime(data[db_utils.SLOTS])
+                slots_saved = self.dbConnector.save_timeslots(decoded_token[db_utils.USER], slots)
+                slots = db_utils.convert_datetime_to_isoformat(slots_saved)
+                pck = utils.create_response_packet(json.dumps({'slots': slots, 'status': 200}).encode())
+
+                # OnSuccess: { slots: [{start, end}], status: 200 }
+                self.send(s, pck)
+
+        elif action == utils.TIMESLOTS_GET_DAYSLOTS:  # { token, date, [compress] }
+            token = data[db_utils.TOKEN]
+            decoded_token = utils.decode_auth_token(token)
+            if not decoded_token:
+                self.send(s, utils.create_invalid_token_packet())
+            else:
+                slots_day = self.dbConnector.get_day_slots(data[db_utils.DATE])
+                slots = db_utils.convert_datetime_to_isoformat(slots_day)
+                pck = utils.create_response_packet(json.dumps({'slots': slots, 'status': 200}).encode())
+
+                # OnSuccess: { slots: [{start, end, user_id}], status: 200 }
+                self.send(s, pck, data.get(db_utils.COMPRESS, False))
+
+        elif action == utils.TIMESLOTS_GET_USERSLOTS:  # { token, [compress] }
+            token = data[db_utils.TOKEN]
+            decoded_token = utils.decode_auth_token(token)
+            if not decoded_token:
+                self.send(s, utils.create_invalid_token_packet())
+            else:
+                user_slots = self.dbConnector.get_user_slots(decoded_token[db_utils.USER])
+                slots = db_utils.convert_datetime_to_isoformat(user_slots)
+                pck = utils.create_response_packet(json.dumps({'slots': slots, 'status': 200}).encode())
+
+                # OnSuccess: { slots: [{slot_id, start, end}], status: 200 }
+                self.send(s, pck, data.get(db_utils.COMPRESS, False))
+
+        elif action == utils.NODETYPES_GET:  # { token, [version], [compress] }
+            token = data[db_utils.TOKEN]
+            decoded_token = utils.decode_auth_token(token)
+            if not decoded_token:
+                self.send(s, utils.create_invalid_token_packet())
+            else:
+                # OnSuccess: { nodetypes, version, status: 200 } or { version, status: 304 }
+                self.send(s, self.get_cached_response('nodetypes', data.get('version'),
+                                                      self.dbConnector.get_nodetypes_version(),
+                                                      self.dbConnector.get_nodetypes),
+                          data.get(db_utils.COMPRESS, False))
+
+        elif action == utils.USERS_SIGNUP:  # { email, username, password }
+            res = self.dbConnector.create_user(data)
+            pck = utils.create_response_packet(json.dumps(res).encode())
+
+            # OnSuccess: { status: 201 }
+            # OnError  : { message, status: 403 }
+            self.send(s, pck)
+
+        elif action == utils.USERS_LOGIN:  # { email, username }
+            res = self.dbConnector.login_user(data)
+            pck = utils.create_response_packet(json.dumps(res).encode())
+
+            # OnSuccess: { token, status: 200}
+            # OnError  : { message, status: 401 }
+            self.send(s, pck)
+
+        elif action == utils.DEBUG_START:  # { token, slot_id }
+            token = data[db_utils.TOKEN]
+            slot_id = data[db_utils.TIMESLOT_ID]
+            decoded_token = utils.decode_auth_token(token)
+            if not decoded_token:
+                self.send(s, utils.create_invalid_token_packet())
+            elif not self.dbConnector.get_slot_by_id(slot_id):
+                self.send(s, utils.create_invalid_slot_packet())
+            else:
+                if self.sock_debug and self.sock_debug is not s:
+                    self.remove_socket(self.sock_debug)
+                if slot_id == self.ended_slot_id:   # Log again what DEBUG_END stopped logging
+                    self.ended_slot_id = None
+                    self.init_debug(slot_id)
+                log_data = ['=== DEBUG CHANNEL START ===\n===========================\n']
+                pck = utils.create_response_packet(json.dumps({'data': log_data}).encode())
+                self.sock_debug = s
+                self.send(self.sock_debug, pck)
+
+        elif action == utils.DEBUG_END:  # { token, slot_id }
+            token = data[db_utils.TOKEN]
+            slot_id = data[db_utils.TIMESLOT_ID]
+            decoded_token = utils.decode_auth_token(token)
+            if not decoded_token:
+                self.send(s, utils.create_invalid_token_packet())
+            elif not self.dbConnector.get_slot_by_id(slot_id):
+                self.send(s, utils.create_invalid_slot_packet())
+            else:
+                log_data = ['=== DEBUG CHANNEL END ===\n=========================\n']
+                if self.sock_debug:
+                    self.end_debug()
+                    pck = utils.create_response_packet(json.dumps({'data': log_data,
+                                                                   'message': 'STOP DEBUG'}).encode())
+                    self.send(self.sock_debug, pck)
+                    self.close_when_flushed(self.sock_debug)
+                    self.sock_debug = None
+
+                    # { status: 204 }
+                    pck = utils.create_response_packet(json.dumps({'status': 204}).encode())
+                    self.send(s, pck)
+
+        elif action == utils.DEBUG_CLEAR_LOG:  # { token, slot_id }
+            token = data[db_utils.TOKEN]
+            slot_id = data[db_utils.TIMESLOT_ID]
+            decoded_token = utils.decode_auth_token(token)
+            if not decoded_token:
+                self.send(s, utils.create_invalid_token_packet())
+            elif not self.dbConnector.get_slot_by_id(slot_id):
+                self.send(s, utils.create_invalid_slot_packet())
+            else:
+                self.clear_debug_log(decoded_token[db_utils.USER], slot_id)
+                pck = utils.create_response_packet(json.dumps({'status': 204}).encode())
+
+                # OnSuccess: { status: 204 }
+                self.send(s, pck)
+
+        elif action == utils.DEBUG_GET_LOG:  # { token, slot_id, [offset], [length] }
+            token = data[db_utils.TOKEN]
+            slot_id = data[db_utils.TIMESLOT_ID]
+            decoded_token = utils.decode_auth_token(token)
+            if not decoded_token:
+                self.send(s, utils.create_invalid_token_packet())
+            elif not self.dbConnector.get_slot_by_id(slot_id):
+                self.send(s, utils.create_invalid_slot_packet())
+            else:
+                # OnSuccess: the log bytes [offset, offset + length) in a response frame
+                self.send_debug_log(s, decoded_token[db_utils.USER], slot_id,
+                                    data.get(db_utils.LOG_OFFSET, 0), data.get(db_utils.LOG_LENGTH))
+
+        elif action == utils.DEBUG_GATEWAY:  # [ TIMESTAMP, NODE_ID, DATA ]
+            print(data[0], '|', data[1], '|', data[2])
+            if self.experiment_info:
+                self.write_debug_log(data)
+            if self.sock_debug:
+                pck = utils.create_response_packet(json.dumps({'data': data}).encode())
+                self.send(self.sock_debug, pck)
+
+    def get_cached_response(self, name, client_version, version, load):
+        """Response packet with the `name` list, or a "not modified" one if the client has this version
+
+        The packet is serialized once per version. The version is read before the data, so a change
+        in between is at worst sent again with the next version.
+        """
+        if client_version == version:
+            return utils.create_not_modified_packet(version)
+
+        cached = self.responses.get(name)
+        if cached is None or cached[0] != version:
+            cached = (version, utils.create_response_packet(
+                json.dumps({name: load(), 'version': version, 'status': 200}).encode()
+            ))
+            self.responses[name] = cached
+        return cached[1]
+
+    def add_socket(self, s):
+        s.setblocking(False)
+        self.selector.register(s, selectors.EVENT_READ)
+        self.outputs[s] = collections.deque()
+        self.readers[s] = utils.FrameReader()
+
+    def remove_socket(self, s):
+        pending = self.outputs.pop(s, None)
+        if pending is None:
+            return
+        for entry in pending:
+            if isinstance(entry, utils.FileSegment):
+                entry.close()
+        self.readers.pop(s, None)
+        # The received data stays in the upload file, a new IMAGE_UPLOAD_BEGIN resumes it
+        for upload_id in [upload_id for upload_id, upload in self.uploads.items() if upload['socket'] is s]:
+            del self.uploads[upload_id]
+        self.closing.discard(s)
+        self.selector.unregister(s)
+        s.close()
+
+    def disconnect(self, s):
+        job = self.pop_gateway_job(s)
+        if job:     # Gateway closed the connection (or did not reply in time) without replying
+            self.handle_gateway_request(job.request_id, job.failed())
+        self.remove_socket(s)
+
+    def send(self, s, data, compress=False):
+        """Queue data (bytes or a utils.Response) on a socket and write as much as possible without blocking
+
+        `compress` is the client capability flag of the request, see utils.Response.to_bytes.
+        """
+        pending = self.outputs.get(s)
+        if pending is None:
+            if isinstance(data, utils.FileSegment):
+                data.close()
+            return
+        if isinstance(data, utils.FileSegment):
+            pending.append(data)
+            if len(pending) == 1:
+                self.flush(s)
+            return
+        if isinstance(data, utils.Response):
+            try:
+                data = data.to_bytes(self.readers[s].version, compress)
+            except struct.error:    # Over 64 KiB for a client that did not negotiate PROTOCOL_V2
+                self.logger.error('Response of %d bytes too large for [%s]' % (len(data.data), s))
+                data = utils.create_response_too_large_packet().to_bytes(self.readers[s].version)
+        pending.append(memoryview(bytes(data)))
+        if len(pending) == 1:
+            self.flush(s)
+
+    def flush(self, s):
+        """Write pending data until the socket would block; wait for EVENT_WRITE for the rest"""
+        pending = self.outputs.get(s)
+        if pending is None:
+            return
+        try:
+            while pending:
+                if isinstance(pending[0], utils.FileSegment):
+                    pending[0].send(s)
+                    if pending[0].count:
+                        break
+                    pending.popleft().close()
+                    continue
+                sent = s.send(pending[0])
+                if sent < len(pending[0]):
+                    pending[0] = pending[0][sent:]
+                    break
+                pending.popleft()
+        except BlockingIOError:
+            pass
+        except (OSError, EOFError) as e:
+            self.logger.info('TCP SEND ERROR [%s] %s' % (s, e))
+            self.remove_socket(s)
+            return
+
+        if not pending and s in self.closing:
+            self.remove_socket(s)
+            return
+
+        events = selectors.EVENT_WRITE if pending else 0
+        if s not in self.closing:
+            events |= selectors.EVENT_READ
+        if self.selector.get_key(s).events != events:
+            self.selector.modify(s, events)
+
+    def close_when_flushed(self, s):
+        if s not in self.outputs:
+            return
+        self.closing.add(s)
+        self.flush(s)
+
+    def handle_dispatched_jobs(self):
+        for job in self.dispatcher.completed():
+            if job.error is None:
+                self.gateway_sockets[job.sock] = job
+                self.add_socket(job.sock)
+                self.scheduler.call_later(self.timeout_gateway_reply, self.gateway_reply_timeout, job.sock,
+                                          name=self.gateway_reply_task(job))
+            else:
+                self.logger.info('Gateway[%s] request failed: %s' % (job.gateway_id, job.error))
+                self.handle_gateway_request(job.request_id, job.failed())
+
+    def gateway_reply_task(self, job):
+        return 'reply %s Gateway[%s]' % (job.request_id, job.gateway_id)
+
+    def pop_gateway_job(self, s):
+        """Take the job waiting for a reply on a gateway socket, None if there is none"""
+        job = self.gateway_sockets.pop(s, None)
+        if job:
+            self.scheduler.cancel(self.gateway_reply_task(job))
+        return job
+
+    def gateway_reply_timeout(self, s):
+        job = self.gateway_sockets.get(s)
+        if job:
+            self.logger.info('Gateway[%s] did not reply in %ss' % (job.gateway_id, self.timeout_gateway_reply))
+            self.disconnect(s)
+
+    def handle_gateway_report(self, job, nodes, done_status=None, flashed=None, image_name=None):
+        """Resolve a gateway report to node uids and store the flash info of the nodes marked `done_status`"""
+        # The gateway of the job is already known, a single query resolves all of its nodes
+        node_uids = self.dbConnector.get_node_uids_by_gateway_id_and_node_ids(
+            job.gateway_id, [node['node_id'] for node in nodes])
+
+        result = []
+        updated_uids = []
+        for node in nodes:
+            node_uid = node_uids.get(node['node_id'])
+            if node['status'] == done_status and node_uid is not None:
+                updated_uids.append(node_uid)
+            result.append({'_id': node_uid, 'status': node['status']})
+
+        if done_status is not None:
+            self.dbConnector.nodes_update_flash_info(updated_uids, flashed, image_name)
+
+        return result
+
+    def handle_gateway_request(self, request_id, data):
+        request = self.gateway_requests[request_id]
+        request['data'].extend(data)
+        request['pending'] -= 1
+        if request['pending'] <= 0:
+            del self.gateway_requests[request_id]
+            if request['web_socket']:
+                pck = utils.create_response_packet(json.dumps({'data': request['data']}).encode())
+                self.send(request['web_socket'], pck)
+
+    def new_gateway_request(self, web_socket, image_name=''):
+        request_id = next(self._request_ids)
+        self.gateway_requests[request_id] = {'web_socket': web_socket, 'data': [], 'pending': 0,
+                                             db_utils.IMAGE_NAME: image_name}
+        return request_id
+
+    def create_gateway_packets(self, web_socket, action, gateway_info, data=None):
+        """Packet of the request to each gateway {gateway_id: packet}, data completed with the node ids
+
+        Gateways speak PROTOCOL_V1, if the node list of a gateway does not fit in a packet the request is
+        answered with an error before anything is sent and None is returned.
+        """
+        packets = {}
+        for gateway_id, nodes in gateway_info.items():
+            gateway_data = dict(data or {}, **{db_utils.NODE_IDS: list(nodes.values())})
+            try:
+                packets[gateway_id] = utils.create_request_packet(action, json.dumps(gateway_data).encode())
+            except struct.error:
+                self.logger.info('Gateway[%s] request of %d nodes too large' % (gateway_id, len(nodes)))
+                if web_socket:
+                    self.send(web_socket, utils.create_request_too_large_packet())
+                return None
+        return packets
+
+    def dispatch_gateway_request(self, request_id, gateway_id, gateway_addr, pck, node_uids, upload=None):
+        self.gateway_requests[request_id]['pending'] += 1
+        self.dispatcher.dispatch(dispatcher.GatewayJob(request_id, gateway_id, gateway_addr, pck, node_uids, upload))
+
+    def send_flash_request(self, web_socket, user_id, image_name, node_uids):
+        nodetype_id = utils.get_nodetype_by_user_and_image_name(user_id, image_name)
 
-    def send_reset_request(self, node_uids):
         gateway_info = self.get_gateway_info(node_uids)
+        packets = self.create_gateway_packets(web_socket, utils.NODES_FLASH, gateway_info,
+                                              {db_utils.IMAGE_NAME: image_name})
+        if packets is None:
+            return
+        gateways_addr = self.dbConnector.get_gateways_addr(gateway_info)
+
+        request_id = self.new_gateway_request(web_socket, image_name)
+        for gateway_id, nodes in gateway_info.items():
+            gateway_addr = gateways_addr[gateway_id]
+            upload = functools.partial(ftp.upload_image, gateway_addr[0], image_name, user_id, nodetype_id)
+            self.dispatch_gateway_request(request_id, gateway_id, gateway_addr, packets[gateway_id], list(nodes),
+                                          upload)
+
+        if not gateway_info:
+            self.handle_gateway_request(request_id, [])
+
+        # if self.prompt_flag:
+        #   self.prompt.update_node_state()
 
-        gateways_sockets = []
-        for gateway_id, node_uids in gateway_info.items():
-            gateway_addr = self.dbConnector.get_gateway_addr(gateway_id)
+    def send_erase_request(self, web_socket, node_uids):
+        self.send_nodes_request(web_socket, utils.NODES_ERASE, node_uids)
 
-            sock_tcp_gateway = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock_tcp_gateway.connect((gateway_addr[0], gateway_addr[1]))
+    def send_reset_request(self, web_socket, node_uids):
+        self.send_nodes_request(web_socket, utils.NODES_RESET, node_uids)
 
-            data = {db_utils.NODE_IDS: []}
-            for node_uid in node_uids:
-                node_id = self.dbConnector.get_node_id_by_uid(node_uid)
-                data[db_utils.NODE_IDS].append(node_id)
-            pck = utils.create_request_packet(utils.NODES_RESET, json.dumps(data).encode())
-            sock_tcp_gateway.sendall(pck)
+    def send_nodes_request(self, web_socket, action, node_uids):
+        """Send an action without data of its own (erase, reset) to the gateways of the nodes"""
+        gateway_info = self.get_gateway_info(node_uids)
+        packets = self.create_gateway_packets(web_socket, action, gateway_info)
+        if packets is None:
+            return
+        gateways_addr = self.dbConnector.get_gateways_addr(gateway_info)
 
-            gateways_sockets.append(sock_tcp_gateway)
+        request_id = self.new_gateway_request(web_socket)
+        for gateway_id, nodes in gateway_info.items():
+            self.dispatch_gateway_request(request_id, gateway_id, gateways_addr[gateway_id], packets[gateway_id],
+                                          list(nodes))
 
-        return gateways_sockets
+        if not gateway_info:
+            self.handle_gateway_request(request_id, [])
 
     def get_gateway_info(self, node_uids):
-        # { gateway_id: [node_uids] }
+        # { gateway_id: {node_uid: node_id} }
         gateway_info = {}
-        for node_uid in node_uids:
-            gateway_id = self.dbConnector.get_gateway_id_by_node_uid(node_uid)
-            if gateway_id in gateway_info:
-                gateway_info[gateway_id].append(node_uid)
-            else:
-                gateway_info[gateway_id] = [node_uid]
+        for node_uid, (gateway_id, node_id) in self.dbConnector.get_nodes_by_uids(node_uids).items():
+            gateway_info.setdefault(gateway_id, {})[node_uid] = node_id
 
         return gateway_info
 
+    def debug_log_path(self, user_id, slot_id):
+        return os.path.dirname(os.path.abspath(__file__)) + '/' + \
+               self.experiment_dir + '/' + \
+               user_id + '/' + slot_id + '.log'
+
     def init_debug(self, slot_id):
         self.experiment_info[db_utils.TIMESLOT_ID] = slot_id
         self.experiment_info[db_utils.USER_ID] = self.dbConnector.get_slot_by_id(slot_id)[db_utils.USER_ID]
-        _dir = os.path.dirname(os.path.abspath(__file__)) + '/' + \
-               self.experiment_dir + '/' + \
-               self.experiment_info[db_utils.USER_ID] + '/'
+        path = self.debug_log_path(self.experiment_info[db_utils.USER_ID], slot_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
 
-        if not os.path.exists(_dir):
-            os.makedirs(_dir)
+        # The log of the experiment is created and kept open by the writer
+        self.log_writer.open(path)
 
-        # Create an empty log for the experiment
-        open(_dir + self.experiment_info[db_utils.TIMESLOT_ID] + '.log', 'a').close()
+    def end_debug(self):
+        self.ended_slot_id = self.experiment_info.get(db_utils.TIMESLOT_ID)
+        self.experiment_info = {}
+        self.log_writer.close()
 
     def write_debug_msg(self, data):
-        _dir = os.path.dirname(os.path.abspath(__file__)) + \
-               '/' + self.experiment_dir + '/' + \
-               self.experiment_info[db_utils.USER_ID] + '/'
-
-        with open(_dir + self.experiment_info[db_utils.TIMESLOT_ID] + '.log', 'a') as f:
-            f.write(f'{data[0]}')
+        self.log_writer.write(f'{data[0]}')
 
     def write_debug_log(self, data):
-        _dir = os.path.dirname(os.path.abspath(__file__)) + \
-               '/' + self.experiment_dir + '/' + \
-               self.experiment_info[db_utils.USER_ID] + '/'
-
-        with open(_dir + self.experiment_info[db_utils.TIMESLOT_ID] + '.log', 'a') as f:
-            f.write(f'{data[0]} | {data[1]:35} | {data[2]}\n')
+        self.log_writer.write(f'{data[0]} | {data[1]:35} | {data[2]}\n')
 
     def clear_debug_log(self, user_id, slot_id):
-        _dir = os.path.dirname(os.path.abspath(__file__)) + \
-               '/' + self.experiment_dir + '/' + \
-               user_id + '/'
-
-        # Erase contents
-        with open(_dir + slot_id + '.log', 'w'):
-            pass
-
-    def send_debug_log(self, s, user_id, slot_id):
-        _dir = os.path.dirname(os.path.abspath(__file__)) + \
-               '/' + self.experiment_dir + '/' + \
-               user_id + '/'
-
-        file_size = os.path.getsize(_dir + slot_id + '.log')
-
-        with open(_dir + slot_id + '.log', 'rb') as f:
-            data = utils.data_size_to_bytes(file_size) + f.read(1022)
-            while data:
-                s.sendall(data)
-                data = f.read(1024)
-
-    def check_timeouts(self):
-        slots_start_timeout = self.slotsStartWatch.time_remaining
-        if slots_start_timeout < 0:
-            slot_start_id = self.dbConnector.check_slots_start()
-            if slot_start_id:
-                self.init_debug(slot_start_id)
-            self.slotsStartWatch.refresh()
-        slots_end_timeout = self.slotsEndWatch.time_remaining
-        if slots_end_timeout < 0:
-            slot_end_id = self.dbConnector.check_slots_end()
-            if slot_end_id:
-                self.dbConnector.delete_slot_by_id(slot_end_id)
-                self.slot_ended()
-            self.slotsEndWatch.refresh()
-
-    def get_next_timeout(self):
-        slots_start_timeout = self.slotsStartWatch.time_remaining
-        slots_end_timeout = self.slotsEndWatch.time_remaining
-
-        new_timeout = min(slots_start_timeout, slots_end_timeout)
-        if new_timeout < 0:
-            return 0
-        return new_timeout
+        # Erase contents, through the writer so that lines still buffered do not come back after it
+        self.log_writer.clear(self.debug_log_path(user_id, slot_id))
+
+    def send_debug_log(self, s, user_id, slot_id, offset=0, length=None):
+        """Queue the log, from `offset` (from the end if negative) and up to `length` bytes
+
+        The file is sent with sendfile as the socket accepts it, the loop keeps serving the other
+        connections in the meantime. Clients can follow a running experiment by asking for the log
+        from the end of what they already have.
+        """
+        try:
+            f = open(self.debug_log_path(user_id, slot_id), 'rb')
+        except OSError:
+            self.send(s, utils.create_log_not_found_packet())
+            return
+
+        file_size = os.fstat(f.fileno()).st_size
+        offset = max(0, file_size + offset) if offset < 0 else min(offset, file_size)
+        count = file_size - offset if length is None else max(0, min(length, file_size - offset))
+        try:
+            header = utils.data_size_to_bytes(count, self.readers[s].version)
+        except struct.error:    # Over 64 KiB for a client that did not negotiate PROTOCOL_V2
+            f.close()
+            self.send(s, utils.create_response_too_large_packet())
+            return
+
+        self.send(s, header)
+        self.send(s, utils.FileSegment(f, offset, count))
+
+    def check_slots_start(self):
+        slot_start_id = self.dbConnector.check_slots_start()
+        # The running slot is returned on every check, its log is opened once
+        if slot_start_id and slot_start_id not in (self.experiment_info.get(db_utils.TIMESLOT_ID),
+                                                   self.ended_slot_id):
+            self.init_debug(slot_start_id)
+
+    def check_slots_end(self):
+        slot_end_id = self.dbConnector.check_slots_end()
+        if slot_end_id:
+            self.dbConnector.delete_slot_by_id(slot_end_id)
+            if self.experiment_info.get(db_utils.TIMESLOT_ID) == str(slot_end_id):
+                self.end_debug()
+            self.slot_ended()
 
     def slot_ended(self):
         nodes = self.dbConnector.get_nodes()
@@ -565,11 +759,7 @@ class WebHandler(threading.Thread):
             node_uids = []
             for node in nodes:
                 node_uids.append(node['_id'])
-            gateway_socks = self.send_erase_request(node_uids)
-            self.inputs.extend(gateway_socks)
-            self.gateway_sockets.append(gateway_socks)
-            self.gateway_sockets_info.append(
-                {'web_socket': '', 'data': []})
+            self.send_erase_request(None, node_uids)
 
     def stop_thread(self):
         self._stop_thread_event.set()
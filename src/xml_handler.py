@@ -12,12 +12,42 @@ class XmlParser:
         pass
 
     def get_xml_info(self, xml_file):
-        root = self.read_xml(xml_file)
-        gateway_location = self.get_gateway_location(root)
-        nodes_info = self.get_nodes_info(root)
+        gateway_location = {}
+        nodes_info = list(self.iter_xml_info(xml_file, gateway_location))
 
         return gateway_location, nodes_info
 
+    @staticmethod
+    def iter_xml_info(xml_file, gateway_location):
+        """Yield the nodes of a gateway descriptor as they are parsed, filling gateway_location on the way
+
+        The file is read with iterparse and every node element is dropped once its Node is built, so
+        memory does not grow with the number of nodes. As in the tree based parsing, the first child
+        of the root is the gateway location and the second one holds the nodes.
+        """
+        depth = 0
+        section = -1    # Index of the current child of the root
+        parent = None
+        for event, elem in ET.iterparse(xml_file, events=('start', 'end')):
+            if event == 'start':
+                depth += 1
+                if depth == 2:
+                    section += 1
+                    parent = elem
+                continue
+
+            depth -= 1
+            if depth != 2:
+                continue
+            if section == 0:
+                gateway_location[elem.tag] = elem.text
+            elif section == 1:
+                node_type_id = elem.find(db_utils.NODETYPE_ID).text
+                node_id = elem.attrib[db_utils.NODE_ID]
+                location = node.intern_location((item.tag, item.text) for item in elem.find(db_utils.LOCATION))
+                yield node.Node(node_id, node_type_id, location)
+                parent.clear()  # Drop the parsed node elements
+
     @staticmethod
     def read_xml(xml_file):
         tree = ET.parse(xml_file)
@@ -37,13 +67,11 @@ class XmlParser:
     def get_nodes_info(root):
         """Get id, nodetype_id and location of nodes"""
         nodes_info = []
-        location = {}
         for _node in root[1]:
             node_type_id = _node.find(db_utils.NODETYPE_ID).text
             node_id = _node.attrib[db_utils.NODE_ID]
             node_location = _node.find(db_utils.LOCATION)
-            for item in node_location:
-                location[item.tag] = item.text
+            location = node.intern_location((item.tag, item.text) for item in node_location)
             nodes_info.append(node.Node(node_id, node_type_id, location))
 
         return nodes_info